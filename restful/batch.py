@@ -0,0 +1,169 @@
+'''
+A resource which dispatches several requests in one, saving the round trips
+of the clients which need many resources at once.
+
+The body of a POST to the batch resource is a list of sub-requests, each a
+dict with the 'method' (GET by default), the 'path' (with the query
+string, relative to the root URLconf) and the data of the 'body', if any.
+The response is the list of their results, in the same order, each a dict
+with the 'status', the 'headers' and the 'body' of the response.
+'''
+from StringIO import StringIO
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.urlresolvers import resolve
+from django.db import DEFAULT_DB_ALIAS, close_connection
+from django.http import Http404, HttpResponseBadRequest
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+from django.views.generic.base import View
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from restful.codecs import JSONBackend, JSONRequestDecoder, XMLRequestDecoder, \
+    MsgPackRequestDecoder, JSONResponseEncoder, XMLResponseEncoder, \
+    MsgPackResponseEncoder
+from restful.utils import atomic
+
+
+log = getLogger('restful.batch')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class _Rollback(Exception):
+    """ Raised to roll back the transaction of a failed batch. """
+
+
+class BaseBatchResource(View):
+    http_method_names = ['post']
+
+    # The maximum number of sub-requests in a batch.
+    max_requests = 20
+
+    # When set, the writes of a batch share a transaction (on the ``using``
+    # database): if any of them fails, all of them are rolled back, the
+    # following sub-requests are not run (status 424) and the status of the
+    # batch is 400. The transactions of the sub-requests (e.g. bulk writes)
+    # are nested in it.
+    atomic_writes = True
+    using = DEFAULT_DB_ALIAS
+
+    # The number of threads which run the sub-requests of the batches with
+    # no writes in parallel, each with its own database connection. None
+    # runs them one after the other, in the thread of the batch.
+    thread_pool_size = None
+
+    # The headers of the batch request which are not passed on to the
+    # sub-requests, as they only apply to the batch.
+    batch_only_meta = ('CONTENT_TYPE', 'CONTENT_LENGTH', 'QUERY_STRING',
+        'HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE',
+        'wsgi.input')
+
+    # The attributes set by middlewares on the batch request which are
+    # copied onto the sub-requests.
+    request_attributes = ('user', 'session', 'urlconf', '_dont_enforce_csrf_checks')
+
+    def post(self, request, *args, **kwargs):
+        subrequests = self.data
+        if not isinstance(subrequests, list) or not 0 < len(subrequests) <= self.max_requests \
+                or not all(isinstance(subrequest, dict)
+                           and isinstance(subrequest.get('path'), basestring)
+                           for subrequest in subrequests):
+            return HttpResponseBadRequest('Expected a list of up to %d sub-requests, '
+                                          'each with a path.' % self.max_requests)
+        requests = [self.make_request(request, subrequest.get('method') or 'GET',
+                                      subrequest['path'], subrequest.get('body'))
+                    for subrequest in subrequests]
+        if not any(self.is_write(subrequest) for subrequest in requests):
+            return self.run_parallel(requests)
+        if not self.atomic_writes:
+            return map(self.run, requests)
+        results = []
+        try:
+            with atomic(using=self.using):
+                for subrequest in requests:
+                    results.append(self.run(subrequest))
+                    if self.is_write(subrequest) and results[-1]['status'] >= 400:
+                        raise _Rollback()
+        except _Rollback:
+            self.response_status = 400
+            results.extend({'status': 424, 'error': 'Not run, a previous write failed.'}
+                           for subrequest in requests[len(results):])
+        return results
+
+    def is_write(self, request):
+        return request.method not in SAFE_METHODS
+
+    def make_request(self, request, method, path, body=None):
+        """ Builds a sub-request of the batch request. The body data is sent
+        as JSON, and JSON is the format of the responses, unless the path
+        asks for another.
+        """
+        path, _, query = path.partition('?')
+        content = '' if body is None else JSONBackend().dumps(body).encode('utf-8')
+        meta = dict((key, value) for key, value in request.META.iteritems()
+                    if key not in self.batch_only_meta)
+        meta.update({
+            'REQUEST_METHOD': method.upper(),
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'HTTP_ACCEPT': 'application/json',
+            'wsgi.input': StringIO(content),
+        })
+        if content:
+            meta.update(CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(content)))
+        subrequest = WSGIRequest(meta)
+        # the encoders keep the serialized data on the response, see get_body()
+        subrequest.batched = True
+        for name in self.request_attributes:
+            if hasattr(request, name):
+                setattr(subrequest, name, getattr(request, name))
+        return subrequest
+
+    def run(self, request):
+        """ Dispatches a sub-request to its view, returning its result. """
+        try:
+            view, args, kwargs = resolve(request.path_info, getattr(request, 'urlconf', None))
+            response = view(request, *args, **kwargs)
+        except Http404, e:
+            return {'status': 404, 'error': unicode(e)}
+        except Exception, e:
+            log.exception('Sub-request %s %s failed', request.method, request.path_info)
+            return {'status': 500, 'error': unicode(e)}
+        return {
+            'status': response.status_code,
+            'headers': dict(response.items()),
+            'body': self.get_body(response),
+        }
+
+    def get_body(self, response):
+        """ Returns the data of the response: the serialized one if it was
+        rendered, else its decoded content if JSON, else the content. """
+        if hasattr(response, 'data'):
+            return response.data
+        content = response.content
+        if response.get('Content-Type', '').startswith('application/json'):
+            try:
+                return simplejson.loads(content)
+            except ValueError:
+                pass
+        return smart_unicode(content) or None
+
+    def run_parallel(self, requests):
+        if not self.thread_pool_size or len(requests) < 2:
+            return map(self.run, requests)
+        pool = ThreadPool(min(self.thread_pool_size, len(requests)))
+        try:
+            return pool.map(self._run_in_thread, requests)
+        finally:
+            pool.close()
+
+    def _run_in_thread(self, request):
+        try:
+            return self.run(request)
+        finally:
+            close_connection()
+
+
+class BatchResource(JSONRequestDecoder, XMLRequestDecoder, MsgPackRequestDecoder,
+    JSONResponseEncoder, XMLResponseEncoder, MsgPackResponseEncoder, BaseBatchResource):
+    pass
@@ -0,0 +1,101 @@
+'''
+Cache of rendered responses, invalidated through the model signals.
+
+Every watched model has a version number in the cache, which is bumped
+whenever an instance is saved or deleted, or an m2m relation changes. The
+keys of the cached responses include the versions of all the models they
+were built from, so changing any of them makes the old entries unreachable
+(they just expire).
+
+Changes of the other models don't touch the cache. Resources caching
+responses or counts watch their models when their view dispatches its first
+request, and so do the reads of the versions; processes which write without
+serving the resources (e.g. task workers) must watch() the cached models
+themselves.
+
+The cache backend is the one named by the RESTFUL_CACHE setting
+(default: 'default').
+'''
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from hashlib import md5
+import time
+
+_cache = []
+
+# The (concrete) models whose changes invalidate the cache.
+_watched = set()
+
+def get_response_cache():
+    """ Returns the cache backend used for responses and versions. """
+    if not _cache:
+        _cache.append(get_cache(getattr(settings, 'RESTFUL_CACHE', 'default')))
+    return _cache[0]
+
+
+def _concrete_model(model):
+    while model._meta.proxy: # deferred classes are proxies, too
+        model = model._meta.proxy_for_model
+    return model
+
+def _version_key(model):
+    model = _concrete_model(model)
+    return 'restful:version:%s.%s' % (model._meta.app_label,
+                                      model._meta.object_name.lower())
+
+
+def watch(models):
+    """ Makes the changes of the models invalidate the cache. """
+    _watched.update(_concrete_model(model) for model in models)
+
+def _new_version():
+    # Versions start from the current time, so that a version evicted from
+    # the cache never takes again a value used before.
+    return int(time.time() * 1000)
+
+
+def get_versions(models):
+    """ Returns the current versions of the models, with a single cache
+    request when all of them are known.
+    """
+    watch(models)
+    cache = get_response_cache()
+    keys = [_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version())
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate(model):
+    """ Makes unreachable all the responses built from instances of model. """
+    cache = get_response_cache()
+    key = _version_key(model)
+    try:
+        cache.incr(key)
+    except ValueError: # the key is missing
+        cache.set(key, _new_version())
+
+
+def get_cache_key(*parts):
+    """ Builds a response key out of any number of repr()-able parts. """
+    return 'restful:response:%s' % md5(repr(parts)).hexdigest()
+
+
+
+def _model_changed(sender, **kwargs):
+    if _concrete_model(sender) in _watched:
+        invalidate(sender)
+
+def _relation_changed(sender, instance, action, model, **kwargs):
+    if action.startswith('post_'):
+        for changed in (instance.__class__, model):
+            if _concrete_model(changed) in _watched:
+                invalidate(changed)
+
+post_save.connect(_model_changed, dispatch_uid='restful.cache.post_save')
+post_delete.connect(_model_changed, dispatch_uid='restful.cache.post_delete')
+m2m_changed.connect(_relation_changed, dispatch_uid='restful.cache.m2m_changed')
@@ -4,16 +4,378 @@ Created on Feb 11, 2011
 @author: saverio
 '''
 from StringIO import StringIO
-from collections import defaultdict
+from collections import defaultdict, Iterator
+from functools import wraps
+from itertools import chain
 from xml.etree import ElementTree
+try:
+    from xml.etree import cElementTree as FastElementTree
+except ImportError:
+    FastElementTree = ElementTree
 import re
-from django.conf import ConfigurationError
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.wsgi import LimitedStream
+from django import http
+from django.conf import settings
 from django.core.serializers.json import DateTimeAwareJSONEncoder
-from django.http import HttpResponseBadRequest, HttpResponse
+from django.db.models.query import QuerySet
+from django.http import HttpResponseBadRequest, HttpResponse, \
+    HttpResponseNotModified
+from django.utils.datastructures import SortedDict
 from django.utils import simplejson
+from django.utils.cache import patch_vary_headers
 from django.utils.encoding import smart_unicode
+from django.utils.http import parse_etags, quote_etag
+from hashlib import md5
+import zlib
 from django.utils.xmlutils import SimplerXMLGenerator
-from restful.utils import serialize
+from restful.cache import get_response_cache, get_versions, get_cache_key, watch
+from restful.http import HttpResponseNotAcceptable
+from restful.timing import get_timing, timed
+from decimal import Decimal
+import datetime
+try:
+    import msgpack
+except ImportError:
+    from restful import msgpack_fallback as msgpack
+from restful.utils import serialize, serialize_iter, smart_bool, \
+    get_serialization_plan, restrict_fields, FieldSpec
+
+# Django < 1.5 streams any HttpResponse built on an iterator.
+StreamingHttpResponse = getattr(http, 'StreamingHttpResponse', HttpResponse)
+
+
+def is_streaming(response):
+    """ Whether the response content is an iterator, to be consumed once. """
+    return getattr(response, 'streaming', False) \
+        or not getattr(response, '_is_string', True)
+
+
+def etag_matches(request, etag):
+    """ Whether the ETag, or any of its compressed variants, is listed in
+    the request's If-None-Match header. """
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return '*' in etags or decoded_etag(etag) in [decoded_etag(quote_etag(tag))
+                                                  for tag in etags]
+
+
+def buffered(chunks, size=8192):
+    """ Joins the chunks of a streamed response into strings of at least
+    ``size`` characters, to avoid too many small writes. Encoded and unicode
+    chunks can be mixed only if the encoded ones are plain ASCII.
+    """
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def parse_accept_header(value):
+    """ Parses an Accept* header into a list of (value, q) pairs, in the
+    order they are listed. Missing or invalid q-values count as 1.
+    """
+    accepted = []
+    for part in value.split(','):
+        params = part.split(';')
+        token = params[0].strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, param_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = min(max(float(param_value), 0.0), 1.0)
+                except ValueError:
+                    pass
+        accepted.append((token, q))
+    return accepted
+
+
+# The window bits selecting the zlib container of each content encoding:
+# 'deflate' is the zlib format (RFC 1950), as HTTP means it.
+_compression_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+def compress(content, encoding, level=6):
+    """ Compresses a string with the 'gzip' or 'deflate' content encoding. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _compression_wbits[encoding])
+    return compressor.compress(content) + compressor.flush()
+
+def compress_chunks(chunks, encoding, level=6):
+    """ Compresses an iterable of strings lazily, flushing the output after
+    each chunk, so that a streamed response still flows to the client.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _compression_wbits[encoding])
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def decompress(content):
+    """ Decompresses a string in any of the content encodings above. """
+    return zlib.decompress(content, 32 + zlib.MAX_WBITS) # detects the header
+
+
+# The compressed variants of a response have their own ETags, the one of
+# the plain content with the encoding appended: "<etag>;gzip".
+def encoded_etag(etag, encoding):
+    return '%s;%s"' % (etag[:-1], encoding) if etag.endswith('"') else etag
+
+def decoded_etag(etag):
+    """ Returns the ETag of the plain content, out of any variant's. """
+    for encoding in _compression_wbits:
+        suffix = ';%s"' % encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def _encoded_chunks(response):
+    if hasattr(response, 'streaming_content'):
+        return response.streaming_content
+    charset = response._charset
+    return (chunk.encode(charset) if isinstance(chunk, unicode) else str(chunk)
+            for chunk in response._container)
+
+def compress_response(response, encoding, level=6, min_length=0):
+    """ Compresses the content of a response, either buffered (when at
+    least ``min_length`` bytes long) or streamed.
+    """
+    if is_streaming(response):
+        chunks = compress_chunks(_encoded_chunks(response), encoding, level)
+        if hasattr(response, 'streaming_content'):
+            response.streaming_content = chunks
+        else:
+            response._container = chunks
+    else:
+        content = response.content
+        if len(content) < min_length:
+            return response
+        response.content = compress(content, encoding, level)
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+    response['Content-Encoding'] = encoding
+    if response.has_header('ETag'):
+        response['ETag'] = encoded_etag(response['ETag'], encoding)
+    return response
+
+def decompress_response(response):
+    """ Decompresses the content of a buffered response. """
+    content = decompress(response.content)
+    del response['Content-Encoding']
+    response.content = content
+    if response.has_header('Content-Length'):
+        response['Content-Length'] = str(len(content))
+    if response.has_header('ETag'):
+        response['ETag'] = decoded_etag(response['ETag'])
+    return response
+
+
+# The default hook for JSON backends: encodes dates, times and decimals as
+# DateTimeAwareJSONEncoder does, without requiring a JSONEncoder subclass.
+json_default = DateTimeAwareJSONEncoder().default
+
+
+class JSONBackend(object):
+    """ The default JSON backend, based on django's simplejson. Compact output
+    (no indentation) is handled by the C-accelerated encoder, when available.
+    Subclasses can use faster libraries by overriding dumps().
+    """
+    def __init__(self, indent=None):
+        self.indent = indent
+
+    def dumps(self, data):
+        separators = (',', ': ') if self.indent else (',', ':')
+        return simplejson.dumps(data, default=json_default, ensure_ascii=False,
+                                indent=self.indent, separators=separators)
+
+
+# Extension type codes for the values MessagePack has no type for. The
+# payload is their ISO 8601 (or decimal) representation.
+MSGPACK_DATETIME = 1
+MSGPACK_DATE = 2
+MSGPACK_TIME = 3
+MSGPACK_DECIMAL = 4
+
+def msgpack_default(obj):
+    """ The default hook for msgpack: packs dates, times and decimals as
+    extension types. """
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(MSGPACK_DATETIME, obj.isoformat())
+    elif isinstance(obj, datetime.date):
+        return msgpack.ExtType(MSGPACK_DATE, obj.isoformat())
+    elif isinstance(obj, datetime.time):
+        return msgpack.ExtType(MSGPACK_TIME, obj.isoformat())
+    elif isinstance(obj, Decimal):
+        return msgpack.ExtType(MSGPACK_DECIMAL, str(obj))
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+def _parse_time(value, fmt):
+    if '.' in value:
+        fmt += '.%f'
+    return datetime.datetime.strptime(value, fmt)
+
+def msgpack_ext_hook(code, data):
+    """ The ext_hook for msgpack: unpacks the types of msgpack_default(). """
+    if code == MSGPACK_DATETIME:
+        return _parse_time(data, '%Y-%m-%dT%H:%M:%S')
+    elif code == MSGPACK_DATE:
+        return datetime.datetime.strptime(data, '%Y-%m-%d').date()
+    elif code == MSGPACK_TIME:
+        return _parse_time(data, '%H:%M:%S').time()
+    elif code == MSGPACK_DECIMAL:
+        return Decimal(data)
+    return msgpack.ExtType(code, data)
+
+def msgpack_dumps(data):
+    return msgpack.packb(data, default=msgpack_default, use_bin_type=False)
+
+def msgpack_loads(content):
+    try:
+        return msgpack.unpackb(content, ext_hook=msgpack_ext_hook, raw=False)
+    except TypeError: # msgpack < 0.5.2 has no 'raw'
+        return msgpack.unpackb(content, ext_hook=msgpack_ext_hook, encoding='utf-8')
+
+
+class JSONArrayReader(object):
+    """ Decodes a JSON document read from a file-like object. If it is an
+    array, iterating over the reader yields its items as soon as each one
+    is complete, keeping in memory only a chunk of the input (or the item
+    being decoded, if larger). Anything else can be decoded by load().
+    """
+    whitespace = ' \t\n\r'
+    # the characters which can continue a number
+    number_chars = '.eE+-0123456789'
+
+    def __init__(self, stream, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = simplejson.JSONDecoder()
+        self.buffer, self.offset, self.eof = '', 0, False
+
+    def fill(self):
+        """ Reads another chunk, dropping the consumed input. """
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.offset:] + chunk
+        self.offset = 0
+        return True
+
+    def peek(self):
+        """ Returns the next non-blank character, or '' at the end. """
+        while True:
+            while self.offset < len(self.buffer) \
+                    and self.buffer[self.offset] in self.whitespace:
+                self.offset += 1
+            if self.offset < len(self.buffer):
+                return self.buffer[self.offset]
+            if not self.fill():
+                return ''
+
+    def load(self):
+        """ Decodes the rest of the document as a whole. """
+        return simplejson.loads(self.buffer[self.offset:] + self.stream.read())
+
+    def read_item(self):
+        self.peek()
+        while True:
+            try:
+                item, end = self.decoder.raw_decode(self.buffer, self.offset)
+                # a number may continue in the next chunk
+                if self.eof or not (isinstance(item, (int, long, float, Decimal))
+                        and not isinstance(item, bool)
+                        and (end == len(self.buffer) or self.buffer[end] in self.number_chars)):
+                    self.offset = end
+                    return item
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def __iter__(self):
+        if self.peek() != '[':
+            raise ValueError('Expected a JSON array.')
+        self.offset += 1
+        if self.peek() == ']':
+            self.offset += 1
+        else:
+            while True:
+                yield self.read_item()
+                separator = self.peek()
+                self.offset += 1
+                if separator == ']':
+                    break
+                elif separator != ',':
+                    raise ValueError('Expected "," or "]" after an array item.')
+        if self.peek():
+            raise ValueError('Extra data after the JSON array.')
+
+
+def iterparse_data(stream, streaming=False):
+    """ Decodes an XML document in the form written by XMLResponseEncoder,
+    in a single iterparse pass: the root is a <response> element, elements
+    whose children are all <resource> are lists, elements with other
+    children are dicts, the others are strings (booleans are '0' and '1').
+    Elements are cleared as soon as they are converted.
+    If ``streaming``, a list is returned as an iterator, yielding its items
+    as soon as each one is parsed.
+    """
+    parsed = _iterparse_items(stream)
+    is_item, value = next(parsed)
+    if not is_item:
+        return value
+    items = chain([value], (value for is_item, value in parsed))
+    return items if streaming else list(items)
+
+def _iterparse_items(stream):
+    """ Yields (True, item) for each item of a list document, as soon as
+    it is complete, or (False, data) for any other document.
+    """
+    # the tags and the converted children of the open elements
+    stack = []
+    root = is_list = None # is_list is decided by the first child
+    for event, element in FastElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            elif is_list is None:
+                is_list = element.tag == 'resource'
+            stack.append((element.tag, []))
+            continue
+        tag, children = stack.pop()
+        if not children:
+            value = unicode(element.text or u'')
+        elif all(child_tag == 'resource' for child_tag, child in children):
+            value = [child for child_tag, child in children]
+        else:
+            value = dict(children)
+        element.clear()
+        if not stack:
+            if not is_list:
+                yield False, value
+            continue
+        if len(stack) == 1:
+            root.clear() # drops the converted children
+        if len(stack) == 1 and is_list:
+            yield True, value
+        else:
+            stack[-1][1].append((tag, value))
+
+
+def body_stream(request):
+    """ Returns a file-like object over the request body, which can be read
+    in chunks of any size. """
+    return LimitedStream(request, int(request.META.get('CONTENT_LENGTH') or 0))
 
 
 class BaseRequestDecoder(object):
@@ -21,6 +383,12 @@ class BaseRequestDecoder(object):
     to provide support for multiple content types.
     """
 
+    # When set, request bodies holding a list are decoded lazily: the data
+    # is an iterator over the items, which are read from the request as they
+    # are consumed (bulk writes consume them bulk_batch_size at a time), so
+    # large uploads are never loaded as a whole.
+    stream_requests = False
+
     def decode_postdata(self, request, *args, **kwargs):
         """ Subclasses must implement this method, by checking the compatibility
         of the request's CONTENT_TYPE with the subclass supported one. In case
@@ -28,15 +396,19 @@ class BaseRequestDecoder(object):
         """
         raise NotImplementedError('The method "decode_postdata()" must be implemented in subclasses')
 
+    @timed
     def dispatch(self, request, *args, **kwargs):
         """ Load the request data into a dictionary, using any decoder 
         implemented by subclasses.
         """
         self.data = None
         self.request_content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
-        if request.method.lower() in ('put', 'post') and request.POST:
+        # request.POST is always empty for PUT requests, look at the length
+        if request.method.lower() in ('put', 'patch', 'post') \
+                and int(request.META.get('CONTENT_LENGTH') or 0) > 0:
             try:
-                self.data = self.decode_postdata(request)
+                with get_timing(self).phase('decode'):
+                    self.data = self.decode_postdata(request)
                 request.POST = dict()
             except NotImplementedError:
                 return HttpResponseBadRequest('Cannot decode POST data of type %s.' % self.request_content_type)
@@ -71,19 +443,36 @@ class JSONRequestDecoder(BaseRequestDecoder):
 
     def decode_postdata(self, request, *args, **kwargs):
         if self.request_content_type in JSONRequestDecoder.content_types:
+            if self.stream_requests:
+                reader = JSONArrayReader(body_stream(request))
+                return iter(reader) if reader.peek() == '[' else reader.load()
             return simplejson.load(request)
         else:
             return super(JSONRequestDecoder, self).decode_postdata(request, *args, **kwargs)
 
 
+class MsgPackRequestDecoder(BaseRequestDecoder):
+    """ The MessagePack request decoder. Dates, times and decimals can be
+    sent as the extension types of msgpack_default().
+    """
+    content_types = ['application/x-msgpack', 'application/msgpack']
+
+    def decode_postdata(self, request, *args, **kwargs):
+        if self.request_content_type in MsgPackRequestDecoder.content_types:
+            return msgpack_loads(request.read())
+        else:
+            return super(MsgPackRequestDecoder, self).decode_postdata(request, *args, **kwargs)
+
+
 class XMLRequestDecoder(BaseRequestDecoder):
-    # FIXME: This should retrun a dict-like object, not a ElemetTree root.
+    """ The XML request decoder, for documents in the form written by
+    XMLResponseEncoder (see iterparse_data()).
+    """
     content_types = 'application/xml'
 
     def decode_postdata(self, request, *args, **kwargs):
         if self.request_content_type in XMLRequestDecoder.content_types:
-            root = ElementTree.parse(request).getroot()
-            return root
+            return iterparse_data(body_stream(request), self.stream_requests)
         else:
             return super(XMLRequestDecoder, self).decode_postdata(request, *args, **kwargs)
 
@@ -104,21 +493,134 @@ class BaseResponseEncoder(object):
     # serialized into several different forms.
     fieldset_marker = None
     
+    # A request parameter listing the fields to serialize, as comma-separated
+    # dotted paths (e.g. 'fields=username,groups.name'). Only the fields in
+    # the spec which would be serialized otherwise can be asked, and they are
+    # the only ones loaded from the database. Paths out of the spec are
+    # ignored, and so is the parameter if none is valid or the spec is empty.
+    sparse_fields_marker = None
+
     # The field resolver object. Subclasses can use the FieldSpec class or a 
     # simpler defaultdict for fallback behaviour. If the consumer can't
     # specify a serialization form, set it to just a tuple.
     fields = tuple() # for fixed serialization
     # fields = defaultdict(tuple) # for polymorphic serialization
+
+    # When set, unpaginated collections are serialized and rendered one item
+    # at a time, into an iterator-backed response.
+    streaming = False
+
+    # When set, rendered GET responses without an ETag get one hashed from
+    # their content, and a 304 if it matches the request's If-None-Match.
+    # This saves bandwidth, not rendering: see RestfulMixin.last_modified_field.
+    etag_content = False
+
+    # The number of seconds rendered GET responses are cached for, in the
+    # RESTFUL_CACHE backend; None disables the cache. Responses are keyed on
+    # the path, the format and the query parameters, and invalidated when
+    # instances of the serialized models change: resources whose content
+    # depends on anything else (e.g. the user) must not be cached.
+    cache_timeout = None
+
+    # The content encodings responses can be compressed with, by preference,
+    # e.g. ('gzip', 'deflate'): the first one accepted by the request is
+    # used. Buffered responses shorter than compress_min_length are sent
+    # as they are; streamed ones are compressed on the fly. Cached responses
+    # are stored compressed with the first encoding.
+    content_encodings = ()
+    compress_level = 6
+    compress_min_length = 1024
+
+    # When set, the phases of each request (decoding, querying, paginating,
+    # serializing, rendering...) are timed along with the queries they run,
+    # and the restful.timing.phases_timed signal is sent with the results.
+    # timing_header adds them to the response, in a Server-Timing header.
+    # Timing turns on the query log of the connections during the request.
+    timing = False
+    timing_header = False
+
+    # Set to 'warn' or 'raise' to report the queries run once per row while
+    # serializing (typically related objects neither selected nor prefetched):
+    # by a warning on the 'restful.timing' logger, or a RepeatedQueries
+    # exception. Meant for development and tests, as it logs the queries.
+    detect_repeated_queries = None
     
     def get_fields(self):
         if self.fieldset_marker and isinstance(self.fields, dict):
-            return self.fields[self.request.GET.get(self.fieldset_marker)]
+            fields = self.fields[self.request.GET.get(self.fieldset_marker)]
         elif isinstance(self.fields, tuple):
-            return self.fields
+            fields = self.fields
         else:
-            raise ConfigurationError("The 'fields' attribute must be either "
+            raise ImproperlyConfigured("The 'fields' attribute must be either "
                                 "a dict (when 'fieldset_marker' is set) or a "
                                 "tuple.")
+        if self.sparse_fields_marker and self.request.GET.get(self.sparse_fields_marker):
+            paths = self.request.GET[self.sparse_fields_marker].split(',')
+            return restrict_fields(fields, [path.strip() for path in paths]) or fields
+        return fields
+
+    def get_default_format(self):
+        """ The format of the responses to requests which specify none. """
+        return self.format
+
+    @classmethod
+    def get_renderers(cls):
+        """ Returns the table of the formats the class can render, in order
+        of preference, mapped to (mimetype, render, render_stream) functions.
+        It is built once per class, out of the encoders in its MRO: for each
+        format, the first one wins. If render() or render_stream() are
+        overridden out of an encoder, the table uses the overrides.
+        """
+        if '_renderers' not in cls.__dict__:
+            renderers = SortedDict()
+            overridden = set()
+            for klass in cls.__mro__:
+                if klass is BaseResponseEncoder:
+                    break
+                attrs = klass.__dict__
+                if 'format' not in attrs or 'render' not in attrs:
+                    overridden.update(name for name in ('render', 'render_stream')
+                                      if name in attrs)
+                elif attrs['format'] not in renderers:
+                    renderers[attrs['format']] = (getattr(klass, 'mimetype'),
+                        cls.render.im_func if 'render' in overridden else attrs['render'],
+                        cls.render_stream.im_func if 'render_stream' in overridden
+                        else attrs.get('render_stream', BaseResponseEncoder.render_stream.im_func))
+            cls._renderers = renderers
+        return cls._renderers
+
+    def negotiate_format(self, request):
+        """ Returns the format the request's Accept header prefers among the
+        renderable ones, the default if there is no header, or None if none
+        is acceptable. The q-value of a format is the one of the most specific
+        range matching its mimetype; ties go to the more specific ranges,
+        then to the default format, then to the table order.
+        """
+        default = self.get_default_format()
+        accept = request.META.get('HTTP_ACCEPT', '').strip()
+        if not accept:
+            return default
+        ranges = parse_accept_header(accept)
+        best, best_quality = None, (0,)
+        for format, (mimetype, render, render_stream) in self.get_renderers().iteritems():
+            matches = {mimetype: 3, mimetype.split('/')[0] + '/*': 2, '*/*': 1}
+            precision, q = 0, 0
+            for media_range, range_q in ranges:
+                if matches.get(media_range, 0) > precision:
+                    precision, q = matches[media_range], range_q
+            quality = (q, precision, format == default)
+            if q > 0 and quality > best_quality:
+                best, best_quality = format, quality
+        return best
+
+    def not_acceptable(self):
+        """ The response to requests for a format which can't be rendered. """
+        response = HttpResponseNotAcceptable('Available formats: %s' % ', '.join(
+            '%s (%s)' % (format, mimetype)
+            for format, (mimetype, _, _) in self.get_renderers().iteritems()),
+            mimetype='text/plain')
+        patch_vary_headers(response, ('Accept',))
+        return response
 
     def render(self, response):
         raise NotImplementedError('%s extends BaseResponseEncoder but does not '
@@ -127,31 +629,234 @@ class BaseResponseEncoder(object):
                             'a default format, or implement render() '
                             'directly.' % self.__class__.__name__)
 
+    def render_stream(self, items):
+        """ Returns a response whose content is rendered while iterating over
+        ``items``, a collection of not yet serialized objects. Encoders which
+        support streaming implement it as render(); if none does, the
+        collection is rendered as a whole.
+        """
+        raise NotImplementedError('No encoder for format %s supports '
+                            'streaming.' % self.format)
+
+    @timed
     def dispatch(self, request, *args, **kwargs):
-        # if the format has ben specified in the request, overwrite the
-        # the default.
-        if 'format' in kwargs:
+        # the format specified in the url takes precedence over the Accept
+        # header, and the default format over nothing
+        negotiated = not kwargs.get('format')
+        if negotiated:
+            self.format = self.negotiate_format(request)
+        else:
             self.format = kwargs['format'].lstrip('.')
+        if self.format not in self.get_renderers():
+            return self.not_acceptable()
+        cache_key = None
+        if self.cache_timeout is not None and request.method == 'GET':
+            # as View.dispatch() does, but the key is needed earlier
+            self.request, self.args, self.kwargs = request, args, kwargs
+            cache_key = self.get_cache_key(request)
+            response = self.get_cached_response(request, cache_key)
+            if response is not None:
+                return self.negotiate_encoding(request, response)
+        # extra headers and status code set by the resource, for the final
+        # response (the status only applies to rendered responses)
+        self.response_headers = {}
+        self.response_status = None
         response = super(BaseResponseEncoder, self).dispatch(request, *args, **kwargs)
+        if not isinstance(response, HttpResponse):
+            response = self.encode(response)
+            if self.response_status is not None:
+                response.status_code = self.response_status
+        for header, value in self.response_headers.iteritems():
+            response[header] = value
+        if self.etag_content and request.method == 'GET' \
+                and response.status_code == 200 and not response.has_header('ETag') \
+                and not is_streaming(response):
+            response = self.hash_content(request, response)
+        if negotiated:
+            patch_vary_headers(response, ('Accept',))
+        if self.content_encodings and response.status_code in (200, 304):
+            patch_vary_headers(response, ('Accept-Encoding',))
+        if cache_key is not None and response.status_code == 200 \
+                and not is_streaming(response):
+            if self.content_encodings:
+                with get_timing(self).phase('compress'):
+                    compress_response(response, self.content_encodings[0],
+                                      self.compress_level, self.compress_min_length)
+            get_response_cache().set(cache_key,
+                (response.content, response.items()), self.cache_timeout)
+        return self.negotiate_encoding(request, response)
+
+    def get_content_encodings(self, request):
+        """ Returns the content_encodings accepted by the request. """
+        if not self.content_encodings:
+            return []
+        accepted = dict(parse_accept_header(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+        default = accepted.get('*', 0)
+        return [encoding for encoding in self.content_encodings
+                if accepted.get(encoding, default) > 0]
+
+    def negotiate_encoding(self, request, response):
+        """ Compresses the response with the preferred content encoding the
+        request accepts or, if it was cached compressed with an encoding the
+        request doesn't accept, turns it back to plain content.
+        """
+        if response.status_code == 304 and self.content_encodings \
+                and response.has_header('ETag'):
+            # the ETag of the variant the request would get
+            etag, accepted = response['ETag'], self.get_content_encodings(request)
+            response['ETag'] = encoded_etag(decoded_etag(etag), accepted[0]) \
+                if accepted else decoded_etag(etag)
+        if response.status_code != 200 or not self.content_encodings:
+            return response
+        accepted = self.get_content_encodings(request)
+        current = response.get('Content-Encoding', None)
+        if current in accepted:
+            return response
+        if current in _compression_wbits and not is_streaming(response):
+            response = decompress_response(response)
+        elif current:
+            return response
+        if accepted:
+            with get_timing(self).phase('compress'):
+                response = compress_response(response, accepted[0],
+                                             self.compress_level, self.compress_min_length)
+        return response
+
+    @classmethod
+    def as_view(cls, *args, **initkwargs):
+        """ Adding to the super, the view watches the models whose changes
+        must invalidate the responses or the counts cached by the resource,
+        when it dispatches its first request. """
+        view = super(BaseResponseEncoder, cls).as_view(*args, **initkwargs)
+        watching = [True]
+        @wraps(view)
+        def watching_view(request, *args, **kwargs):
+            if watching:
+                watching.pop()
+                cls(**initkwargs).watch_cache_models()
+            return view(request, *args, **kwargs)
+        return watching_view
+
+    def watch_cache_models(self):
+        """ Watches the models of all the fields specs (see restful.cache),
+        if the resource caches responses or counts. """
+        if self.cache_timeout is None \
+                and getattr(self, 'count_strategy', None) not in ('cached', 'estimate'):
+            return
+        fieldsets = [self.fields]
+        if isinstance(self.fields, dict):
+            fieldsets = self.fields.values()
+            if isinstance(self.fields, FieldSpec):
+                fieldsets.append(self.fields.default)
+        for fields in chain([()], fieldsets):
+            watch(self.get_cache_models(fields))
+
+    def get_cache_models(self, fields=None):
+        """ Returns the models whose changes invalidate the cached responses:
+        the resource's one and those followed by the fields spec (by default,
+        the one of the request).
+        """
+        model = getattr(self, 'model', None) \
+            or getattr(getattr(self, 'queryset', None), 'model', None)
+        if model is None:
+            return ()
+        if fields is None:
+            fields = self.get_fields()
+        if hasattr(fields, 'serialize'):
+            return (model,)
+        return get_serialization_plan(model, fields).related_models()
+
+    def get_cache_key(self, request):
+        query = sorted((key, sorted(values)) for key, values in request.GET.lists())
+        return get_cache_key(request.path, sorted(self.kwargs.items()),
+                             self.format, query,
+                             get_versions(self.get_cache_models()))
+
+    def get_cached_response(self, request, cache_key):
+        cached = get_response_cache().get(cache_key)
+        if cached is None:
+            return None
+        content, headers = cached
+        response = HttpResponse(content)
+        for header, value in headers:
+            response[header] = value
+        if response.has_header('ETag') and etag_matches(request, response['ETag']):
+            cached, response = response, HttpResponseNotModified()
+            for header in ('ETag', 'Vary'):
+                if cached.has_header(header):
+                    response[header] = cached[header]
+        return response
+
+    def hash_content(self, request, response):
+        etag = quote_etag(md5(response.content).hexdigest())
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    def encode(self, response):
+        """ Turns the value returned by the resource into a response. """
         if isinstance(response, basestring):
             return HttpResponse(response)
         elif isinstance(response, HttpResponse):
             return response
-        else:
+        mimetype, render, render_stream = self.get_renderers()[self.format]
+        if self.streaming and isinstance(response, (QuerySet, Iterator)):
+            try:
+                return render_stream(self, response)
+            except NotImplementedError:
+                pass
+        timing = get_timing(self)
+        with timing.phase('serialize'):
             data = serialize(response, self.get_fields())
-            return self.render(data)
+        with timing.phase('render'):
+            response = render(self, data)
+        if getattr(self.request, 'batched', False):
+            # the batch resource embeds the data, rather than the content
+            response.data = data
+        return response
 
 
 class JSONResponseEncoder(BaseResponseEncoder):
     mimetype = 'application/json'
     format = 'json'
 
+    # The class encoding the data, see JSONBackend.
+    json_backend_class = JSONBackend
+
+    # The output is compact, unless this request parameter is set (to an
+    # empty or true value) or DEBUG is on; then it is indented.
+    indent_marker = 'indent'
+    indent = 2
+
+    def get_json_backend(self):
+        value = self.request.GET.get(self.indent_marker)
+        if settings.DEBUG or value == '' or smart_bool(value):
+            return self.json_backend_class(indent=self.indent)
+        return self.json_backend_class()
+
     def render(self, response):
         if self.format != JSONResponseEncoder.format:
             return super(JSONResponseEncoder, self).render(response)
-        content = simplejson.dumps(response, cls=DateTimeAwareJSONEncoder, ensure_ascii=False, indent=2)
+        content = self.get_json_backend().dumps(response)
         return HttpResponse(content, mimetype=JSONResponseEncoder.mimetype)
 
+    def render_stream(self, items):
+        if self.format != JSONResponseEncoder.format:
+            return super(JSONResponseEncoder, self).render_stream(items)
+        return StreamingHttpResponse(buffered(self._json_chunks(items)),
+                                     mimetype=JSONResponseEncoder.mimetype)
+
+    def _json_chunks(self, items):
+        backend = self.get_json_backend()
+        newline = u'\n' if backend.indent else u''
+        separator = u'[' + newline
+        for data in serialize_iter(items, self.get_fields()):
+            yield separator
+            yield backend.dumps(data)
+            separator = u',' + newline
+        yield newline + u']' if separator == u',' + newline else u'[]'
+
 
 
 class XMLResponseEncoder(BaseResponseEncoder):
@@ -171,6 +876,31 @@ class XMLResponseEncoder(BaseResponseEncoder):
         content = stream.getvalue()
         return HttpResponse(content, mimetype=XMLResponseEncoder.mimetype)
 
+    def render_stream(self, items):
+        if self.format != XMLResponseEncoder.format:
+            return super(XMLResponseEncoder, self).render_stream(items)
+        return StreamingHttpResponse(buffered(self._xml_chunks(items)),
+                                     mimetype=XMLResponseEncoder.mimetype)
+
+    def _xml_chunks(self, items):
+        """ Writes the document as render() does, but serializing the items
+        lazily and flushing the stream after each <resource> element.
+        """
+        stream = StringIO()
+        xml = SimplerXMLGenerator(stream, "utf-8")
+        xml.startDocument()
+        xml.startElement("response", {})
+        for data in serialize_iter(items, self.get_fields()):
+            xml.startElement("resource", {})
+            self._to_xml(xml, data)
+            xml.endElement("resource")
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+        xml.endElement("response")
+        xml.endDocument()
+        yield stream.getvalue()
+
 
     def _to_xml(self, xml, data):
         if isinstance(data, (list, tuple)):
@@ -192,5 +922,16 @@ class XMLResponseEncoder(BaseResponseEncoder):
 
 
 
+class MsgPackResponseEncoder(BaseResponseEncoder):
+    """ Renders responses in MessagePack, a compact binary equivalent of
+    JSON, faster to parse. Dates, times and decimals are packed as extension
+    types (see msgpack_default()). Uses the msgpack package if installed,
+    a pure-Python implementation otherwise.
+    """
+    mimetype = 'application/x-msgpack'
+    format = 'msgpack'
 
-
+    def render(self, response):
+        if self.format != MsgPackResponseEncoder.format:
+            return super(MsgPackResponseEncoder, self).render(response)
+        return HttpResponse(msgpack_dumps(response), mimetype=MsgPackResponseEncoder.mimetype)
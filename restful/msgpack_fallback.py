@@ -0,0 +1,203 @@
+'''
+A pure-Python implementation of the MessagePack format, used by the codecs
+when the msgpack package is not installed. It provides the subset of the
+msgpack API which the codecs use: packb(), unpackb() and ExtType.
+
+Byte strings are packed as the str type, as msgpack does by default on
+Python 2 (use_bin_type=False), so they must be UTF-8.
+'''
+from collections import namedtuple
+import struct
+
+
+class ExtType(namedtuple('ExtType', ['code', 'data'])):
+    """ An extension type: an application-defined code (0-127) and its
+    payload, as a byte string. """
+
+
+def packb(obj, default=None, use_bin_type=False, **kwargs):
+    """ Packs an object into a string. Values of types MessagePack has no
+    format for are passed to ``default``, which must return something
+    packable (typically an ExtType), or raise TypeError.
+    """
+    parts = []
+    _pack(obj, parts.append, default, use_bin_type)
+    return ''.join(parts)
+
+
+def _pack_length(write, length, fix_base, fix_limit, formats):
+    if length < fix_limit:
+        write(chr(fix_base | length))
+        return
+    for marker, fmt, limit in formats:
+        if length <= limit:
+            write(marker + struct.pack(fmt, length))
+            return
+    raise ValueError('Object too large (%d)' % length)
+
+_str_formats = (('\xd9', '>B', 0xff), ('\xda', '>H', 0xffff), ('\xdb', '>I', 0xffffffff))
+_bin_formats = (('\xc4', '>B', 0xff), ('\xc5', '>H', 0xffff), ('\xc6', '>I', 0xffffffff))
+_array_formats = (('\xdc', '>H', 0xffff), ('\xdd', '>I', 0xffffffff))
+_map_formats = (('\xde', '>H', 0xffff), ('\xdf', '>I', 0xffffffff))
+_fixext_markers = {1: '\xd4', 2: '\xd5', 4: '\xd6', 8: '\xd7', 16: '\xd8'}
+_ext_formats = (('\xc7', '>B', 0xff), ('\xc8', '>H', 0xffff), ('\xc9', '>I', 0xffffffff))
+
+def _pack_int(obj, write):
+    if 0 <= obj < 0x80:
+        write(chr(obj))
+    elif -0x20 <= obj < 0:
+        write(struct.pack('>b', obj))
+    elif obj > 0:
+        if obj <= 0xff:
+            write('\xcc' + struct.pack('>B', obj))
+        elif obj <= 0xffff:
+            write('\xcd' + struct.pack('>H', obj))
+        elif obj <= 0xffffffff:
+            write('\xce' + struct.pack('>I', obj))
+        elif obj <= 0xffffffffffffffff:
+            write('\xcf' + struct.pack('>Q', obj))
+        else:
+            raise OverflowError('Integer value out of range')
+    else:
+        if obj >= -0x80:
+            write('\xd0' + struct.pack('>b', obj))
+        elif obj >= -0x8000:
+            write('\xd1' + struct.pack('>h', obj))
+        elif obj >= -0x80000000:
+            write('\xd2' + struct.pack('>i', obj))
+        elif obj >= -0x8000000000000000:
+            write('\xd3' + struct.pack('>q', obj))
+        else:
+            raise OverflowError('Integer value out of range')
+
+def _pack(obj, write, default, use_bin_type):
+    if obj is None:
+        write('\xc0')
+    elif obj is True:
+        write('\xc3')
+    elif obj is False:
+        write('\xc2')
+    elif isinstance(obj, (int, long)):
+        _pack_int(obj, write)
+    elif isinstance(obj, float):
+        write('\xcb' + struct.pack('>d', obj))
+    elif isinstance(obj, unicode) or (isinstance(obj, str) and not use_bin_type):
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        _pack_length(write, len(obj), 0xa0, 32, _str_formats)
+        write(obj)
+    elif isinstance(obj, (str, bytearray)):
+        _pack_length(write, len(obj), 0, 0, _bin_formats)
+        write(str(obj))
+    elif isinstance(obj, ExtType):
+        if not 0 <= obj.code <= 127:
+            raise ValueError('Extension type code out of range (%d)' % obj.code)
+        data = str(obj.data)
+        if len(data) in _fixext_markers:
+            write(_fixext_markers[len(data)])
+        else:
+            _pack_length(write, len(data), 0, 0, _ext_formats)
+        write(struct.pack('>b', obj.code) + data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(write, len(obj), 0x90, 16, _array_formats)
+        for item in obj:
+            _pack(item, write, default, use_bin_type)
+    elif isinstance(obj, dict):
+        _pack_length(write, len(obj), 0x80, 16, _map_formats)
+        for key, value in obj.iteritems():
+            _pack(key, write, default, use_bin_type)
+            _pack(value, write, default, use_bin_type)
+    elif default is not None:
+        value = default(obj)
+        if value is obj:
+            raise TypeError('Cannot serialize %r' % (obj,))
+        _pack(value, write, default, use_bin_type)
+    else:
+        raise TypeError('Cannot serialize %r' % (obj,))
+
+
+def unpackb(packed, ext_hook=ExtType, raw=False, **kwargs):
+    """ Unpacks an object from a string. Strings are decoded from UTF-8
+    unless ``raw`` is set; extension types are passed to ``ext_hook``.
+    Raises ValueError if the data is malformed or incomplete.
+    """
+    packed = str(packed)
+    try:
+        obj, offset = _unpack(packed, 0, ext_hook, raw)
+    except (struct.error, IndexError):
+        raise ValueError('Unexpected end of data')
+    if offset != len(packed):
+        raise ValueError('Extra data')
+    return obj
+
+
+def _read(data, offset, length):
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Unexpected end of data')
+    return data[offset:end], end
+
+# marker: (struct format of the value, its size)
+_scalar_formats = {
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+    0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+}
+# marker: (kind, struct format of the length, its size)
+_sized_formats = {
+    0xc4: ('bin', '>B', 1), 0xc5: ('bin', '>H', 2), 0xc6: ('bin', '>I', 4),
+    0xc7: ('ext', '>B', 1), 0xc8: ('ext', '>H', 2), 0xc9: ('ext', '>I', 4),
+    0xd9: ('str', '>B', 1), 0xda: ('str', '>H', 2), 0xdb: ('str', '>I', 4),
+    0xdc: ('array', '>H', 2), 0xdd: ('array', '>I', 4),
+    0xde: ('map', '>H', 2), 0xdf: ('map', '>I', 4),
+}
+_fixext_lengths = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+_constants = {0xc0: None, 0xc2: False, 0xc3: True}
+
+def _unpack(data, offset, ext_hook, raw):
+    marker = ord(data[offset])
+    offset += 1
+    if marker <= 0x7f:
+        return marker, offset
+    if marker >= 0xe0:
+        return marker - 0x100, offset
+    if marker in _constants:
+        return _constants[marker], offset
+    if marker in _scalar_formats:
+        fmt, size = _scalar_formats[marker]
+        value, offset = _read(data, offset, size)
+        return struct.unpack(fmt, value)[0], offset
+    if marker <= 0x8f:
+        kind, length = 'map', marker & 0x0f
+    elif marker <= 0x9f:
+        kind, length = 'array', marker & 0x0f
+    elif marker <= 0xbf:
+        kind, length = 'str', marker & 0x1f
+    elif marker in _fixext_lengths:
+        kind, length = 'ext', _fixext_lengths[marker]
+    elif marker in _sized_formats:
+        kind, fmt, size = _sized_formats[marker]
+        value, offset = _read(data, offset, size)
+        length = struct.unpack(fmt, value)[0]
+    else:
+        raise ValueError('Invalid marker 0x%x' % marker)
+    if kind == 'array':
+        items = []
+        for _ in xrange(length):
+            item, offset = _unpack(data, offset, ext_hook, raw)
+            items.append(item)
+        return items, offset
+    if kind == 'map':
+        items = {}
+        for _ in xrange(length):
+            key, offset = _unpack(data, offset, ext_hook, raw)
+            items[key], offset = _unpack(data, offset, ext_hook, raw)
+        return items, offset
+    if kind == 'ext':
+        code, offset = _read(data, offset, 1)
+        value, offset = _read(data, offset, length)
+        return ext_hook(struct.unpack('>b', code)[0], value), offset
+    value, offset = _read(data, offset, length)
+    if kind == 'str' and not raw:
+        value = value.decode('utf-8')
+    return value, offset
@@ -0,0 +1,195 @@
+'''
+Paginators for collections which don't fit django's Paginator.
+'''
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.paginator import Paginator, InvalidPage
+from django.db import connections
+from django.db.models import Q, get_models
+from restful.cache import get_response_cache, get_versions, get_cache_key
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class CursorPaginator(object):
+    """ Keyset pagination: the queryset is ordered by a tuple of fields which
+    is unique as a whole, and each page starts right after (or ends right
+    before) the key of a given row, so that no OFFSET and no COUNT are
+    needed and every page costs the same, however deep.
+
+    ``ordering`` is a sequence of local, non-null field names, each
+    optionally prefixed by '-' for descending order. Cursors are opaque
+    strings, encoding the direction and the key of the boundary row.
+    """
+    def __init__(self, queryset, ordering, per_page):
+        opts = queryset.model._meta
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = []
+        for name in ordering:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            self.fields.append((field, descending))
+
+    def get_ordering(self, forward=True):
+        return ['-' + field.name if descending == forward else field.name
+                for field, descending in self.fields]
+
+    def get_key(self, item):
+        """ Returns the values of the ordering fields for an item, either a
+        model instance or a dict. """
+        if isinstance(item, dict):
+            return [item[field.name] for field, _ in self.fields]
+        return [getattr(item, field.attname) for field, _ in self.fields]
+
+    def encode_cursor(self, forward, key):
+        values = [value if isinstance(value, (int, long, float, basestring))
+                  else smart_unicode(value) for value in key]
+        return urlsafe_b64encode(simplejson.dumps([forward] + values))
+
+    def decode_cursor(self, cursor):
+        """ Returns the (forward, key) pair encoded in the cursor. """
+        try:
+            data = simplejson.loads(urlsafe_b64decode(str(cursor)))
+            forward, values = bool(data[0]), data[1:]
+            if len(values) != len(self.fields):
+                raise ValueError('Wrong key length')
+            return forward, [field.to_python(value)
+                             for (field, _), value in zip(self.fields, values)]
+        except Exception:
+            raise InvalidCursor(u'Invalid cursor (%s)' % cursor)
+
+    def filter_after(self, key, forward=True):
+        """ Returns a Q object matching the rows which follow the key in the
+        given direction: (a > a0) | (a == a0 & b > b0) | ...
+        """
+        q = Q()
+        for i, (field, descending) in enumerate(self.fields):
+            lookup = '%s__%s' % (field.name, 'lt' if descending == forward else 'gt')
+            clause = Q(**{lookup: key[i]})
+            for (previous, _), value in zip(self.fields[:i], key[:i]):
+                clause &= Q(**{previous.name: value})
+            q |= clause
+        return q
+
+    def page(self, cursor=None):
+        """ Returns the page following (or preceding) the cursor, as a dict
+        with the 'items' and the 'next'/'prev' cursors (None at the ends).
+        """
+        queryset, forward = self.queryset, True
+        if cursor:
+            forward, key = self.decode_cursor(cursor)
+            queryset = queryset.filter(self.filter_after(key, forward))
+        queryset = queryset.order_by(*self.get_ordering(forward))
+        items = list(queryset[:self.per_page + 1])
+        more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if not forward:
+            items.reverse()
+        has_next, has_prev = (more, bool(cursor)) if forward else (True, more)
+        if items:
+            first, last = self.get_key(items[0]), self.get_key(items[-1])
+        elif cursor: # an empty page, turn back from where it was asked
+            first = last = key
+            has_next, has_prev = not forward, forward
+        else:
+            has_next = has_prev = False
+        return {
+            'next': self.encode_cursor(True, last) if has_next else None,
+            'prev': self.encode_cursor(False, first) if has_prev else None,
+            'items': items,
+        }
+
+
+def _query_models(query):
+    """ Returns the models whose tables are used by a compiled query. """
+    tables = set(getattr(join, 'table_name', None) or join[0]
+                 for alias, join in query.alias_map.items()
+                 if query.alias_refcount.get(alias))
+    tables.add(query.model._meta.db_table)
+    return sorted([model for model in get_models() if model._meta.db_table in tables],
+                  key=lambda model: model._meta.db_table)
+
+
+def cached_count(queryset, timeout=None):
+    """ Counts the rows of the queryset, caching the result under the SQL of
+    the query and the versions of all the models it reads, so that the
+    count is invalidated along with the cached responses.
+    """
+    query = queryset.query.clone()
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    models = _query_models(query)
+    key = get_cache_key('count', queryset.db, sql, params, get_versions(models))
+    cache = get_response_cache()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def estimate_count(queryset):
+    """ Returns the planner's estimate of the rows in the table of queryset,
+    or None when the database can't tell.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables ' \
+              'WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class CachedCountPaginator(Paginator):
+    """ A Paginator which caches the count of the objects for timeout
+    seconds (or until any model read by the query changes), instead of
+    counting them on every page.
+    """
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 timeout=None):
+        super(CachedCountPaginator, self).__init__(object_list, per_page, orphans,
+                                                   allow_empty_first_page)
+        self.timeout = timeout
+
+    def _get_count(self):
+        if self._count is None:
+            if hasattr(self.object_list, 'query'):
+                self._count = self.get_count(self.object_list)
+            else:
+                self._count = len(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+    def get_count(self, queryset):
+        return cached_count(queryset, self.timeout)
+
+
+class EstimatedCountPaginator(CachedCountPaginator):
+    """ A Paginator which takes the planner's estimate as the count of the
+    unfiltered querysets on big tables, where exact counts take long and
+    are soon outdated anyway. Other querysets are counted by cached_count().
+    """
+    # Below this estimate, the count is exact.
+    threshold = 10000
+
+    def get_count(self, queryset):
+        query = queryset.query
+        if not query.where and not query.having and not query.distinct \
+                and not query.extra and query.low_mark == 0 and query.high_mark is None:
+            estimate = estimate_count(queryset)
+            if estimate is not None and estimate >= self.threshold:
+                return estimate
+        return super(EstimatedCountPaginator, self).get_count(queryset)
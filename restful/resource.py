@@ -6,18 +6,64 @@ Created on Feb 14, 2011
 
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, \
     ImproperlyConfigured
+from calendar import timegm
+from collections import defaultdict, Iterator
+from django.contrib.contenttypes.models import ContentType
 from django.core.paginator import Paginator, InvalidPage
-from django.http import Http404, HttpResponseBadRequest, HttpResponseGone
+from django.db import router
+from django.db.models import Count, Max, Model
+from django.db.models.fields import Field, DateField
+from django.db.models.signals import m2m_changed, pre_save, post_save
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.http import Http404, HttpResponseBadRequest, HttpResponseGone, \
+    HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, \
+    quote_etag
+from django.dispatch.dispatcher import Signal, _make_id
+from hashlib import md5
+from inspect import getargspec
 from django.views.generic.base import View
 from itertools import chain
 from logging import getLogger
+from restful.cache import invalidate, get_versions, _model_changed, _concrete_model
 from restful.http import HttpResponseNoContent
+from restful.timing import get_timing
+from restful.pagination import CursorPaginator, CachedCountPaginator, \
+    EstimatedCountPaginator
 from restful.codecs import JSONRequestDecoder, XMLRequestDecoder,\
-    JSONResponseEncoder, XMLResponseEncoder
+    MsgPackRequestDecoder, JSONResponseEncoder, XMLResponseEncoder, \
+    MsgPackResponseEncoder, etag_matches
+from restful.utils import get_serialization_plan, prefetch_related, chunked, \
+    compile_lookups, atomic
 
 
 log = getLogger('restful.resource')
 
+# Whether Model.save() can write only some columns (Django >= 1.5).
+_update_fields = 'update_fields' in getargspec(Model.save)[0]
+
+# Signal._live_receivers() takes the sender from Django 1.6, its id before.
+_receivers_by_sender = 'senderkey' not in getargspec(Signal._live_receivers)[0]
+
+def _has_receivers(signal, sender):
+    """ Whether signal has receivers for sender, besides the response
+    cache's, which is invalidated explicitly when no signal is sent. """
+    if hasattr(signal, 'has_listeners') and not signal.has_listeners(sender):
+        return False
+    receivers = signal._live_receivers(sender if _receivers_by_sender else _make_id(sender))
+    return any(receiver is not _model_changed for receiver in receivers)
+
+def _is_symmetrical(field):
+    """ Whether the m2m field relates its model to itself both ways, so
+    that each relation is stored twice, once per direction. """
+    return getattr(field.rel, 'symmetrical', False) and field.rel.to == field.model
+
+def _plain_pre_save(field):
+    """ Whether saving an instance leaves the value of field as it is. """
+    if isinstance(field, DateField):
+        return not field.auto_now
+    return field.pre_save.im_func is Field.pre_save.im_func
+
 class RestfulMixin(object):
 
     allow_empty = True
@@ -26,9 +72,56 @@ class RestfulMixin(object):
     paginate_by = None
     context_object_name = None
     paginator_class = Paginator
+    # Keyset pagination: a tuple of field names (optionally prefixed by '-')
+    # which is unique as a whole, e.g. ('-date_joined', 'id'). When set, the
+    # pages are selected by the opaque 'cursor' parameter, instead of the
+    # page number, and have the same cost however deep they are.
+    cursor_ordering = None
+    cursor_paginator_class = CursorPaginator
+    # How the total of a paginated collection is counted: None (a COUNT on
+    # every page, by paginator_class), 'cached' (the count is cached for
+    # count_cache_timeout seconds, or until the models queried change),
+    # 'estimate' (the planner's estimate for unfiltered big tables, the
+    # cached count otherwise) or 'more' (no count at all: the pages omit
+    # 'total' and 'pages', and tell whether 'more' items follow).
+    count_strategy = None
+    count_cache_timeout = 60
+    count_paginator_classes = {
+        'cached': CachedCountPaginator,
+        'estimate': EstimatedCountPaginator,
+    }
+    # The number of rows fetched at a time when iterating over a collection
+    # without caching it (i.e. when the response is streamed).
+    chunk_size = 100
     singleton = False
     get_lookups = ()
     kwargs_lookups = ()
+    # The number of filtered querysets kept by get_queryset(), to be cloned
+    # instead of rebuilt when the same filters are asked again; 0 disables
+    # it. Only set it when the default manager (or ``queryset``) returns the
+    # same rows on every request: the filters it applies per request, e.g.
+    # on now() or on the current site, would be frozen in the kept querysets.
+    queryset_cache_size = 0
+    _queryset_cache = {}
+    # Whether the relations followed by the serialization fields spec are
+    # fetched in advance, with select_related() and prefetch_related().
+    auto_related = True
+    # Whether the queries load only the columns listed in the fields spec.
+    # When no relation is followed and all the fields are Django's own ones
+    # (custom fields convert their values in to_python()), collections are
+    # loaded as plain dicts: unset it if object_list must hold instances.
+    auto_columns = True
+    # Conditional GET: the field holding the modification time of the
+    # instances, e.g. 'updated_at'. When set, GET responses carry ETag and
+    # Last-Modified headers computed by a cheap query (the maximum over the
+    # collection), and matching If-None-Match or If-Modified-Since requests
+    # are answered with a 304 before anything is loaded or serialized.
+    # The changes of the related objects in the fields spec are noticed by
+    # the ETag only (see get_related_versions()), not by Last-Modified.
+    last_modified_field = None
+    # The number of rows per INSERT statement in bulk writes (i.e. POST or
+    # PUT of a list to the collection), when the backend supports it.
+    bulk_batch_size = 500
 
 
     def is_collection(self):
@@ -50,19 +143,7 @@ class RestfulMixin(object):
         # like DateDetailView
         if queryset is None:
             queryset = self.get_queryset()
-        # if it is a singleton, skip the PK/slug filter
-        if not self.singleton:
-            pk = self.kwargs.get('pk')
-            slug = self.kwargs.get('slug')
-            if pk is not None: # Next, try looking up by primary key.
-                queryset = queryset.filter(pk=pk)
-            elif slug is not None: # Next, try looking up by slug.
-                slug_field = self.get_slug_field()
-                queryset = queryset.filter(**{slug_field: slug})
-            else: # If none of those are defined, it's an error.
-                raise AttributeError(u"Generic detail view %s must be called with "
-                                     u"either an object id or a slug."
-                                     % self.__class__.__name__)
+        queryset = self.filter_object(queryset)
         try:
             obj = queryset.get()
         except ObjectDoesNotExist:
@@ -74,23 +155,190 @@ class RestfulMixin(object):
                                      % self.__class__.__name__)
         return obj
 
+    def filter_object(self, queryset):
+        """ Filters the queryset by the `pk` or `slug` argument, unless the
+        resource is a singleton.
+        """
+        if self.singleton:
+            return queryset
+        pk = self.kwargs.get('pk')
+        slug = self.kwargs.get('slug')
+        if pk is not None: # Next, try looking up by primary key.
+            return queryset.filter(pk=pk)
+        elif slug is not None: # Next, try looking up by slug.
+            slug_field = self.get_slug_field()
+            return queryset.filter(**{slug_field: slug})
+        else: # If none of those are defined, it's an error.
+            raise AttributeError(u"Generic detail view %s must be called with "
+                                 u"either an object id or a slug."
+                                 % self.__class__.__name__)
+
     def get_queryset(self):
         """ Get the queryset to look up. """
-        if self.queryset is None:
-            if self.model:
-                return self.model._default_manager.all()
+        if self.queryset is None and not self.model:
+            raise ImproperlyConfigured(u"%(cls)s is missing a queryset. Define "
+                                       u"%(cls)s.model, %(cls)s.queryset, or override "
+                                       u"%(cls)s.get_object()." % {
+                                            'cls': self.__class__.__name__
+                                    })
+        parameters = self.get_lookup_parameters()
+        base = self.model if self.queryset is None else self.queryset
+        key = queryset = None
+        if self.queryset_cache_size:
+            try:
+                key = (base, tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                                          for name, value in parameters.iteritems())))
+                queryset = self._queryset_cache.get(key)
+            except TypeError: # unhashable values
+                key = None
+        if queryset is None:
+            if self.queryset is None:
+                queryset = self.model._default_manager.filter(**parameters)
             else:
-                raise ImproperlyConfigured(u"%(cls)s is missing a queryset. Define "
-                                           u"%(cls)s.model, %(cls)s.queryset, or override "
-                                           u"%(cls)s.get_object()." % {
-                                                'cls': self.__class__.__name__
-                                        })
-        parameters = dict()
-        # update with the optional get_lookups filter
-        parameters.update(chain(*(lookup(self.request.GET) for lookup in self.get_lookups)))
-        # update with the optional kwargs_lookups filter
-        parameters.update(chain(*(lookup(self.kwargs) for lookup in self.kwargs_lookups)))
-        return self.queryset._clone().filter(**parameters)
+                queryset = self.queryset._clone().filter(**parameters)
+            if key is not None:
+                if len(self._queryset_cache) >= self.queryset_cache_size:
+                    self._queryset_cache.clear()
+                self._queryset_cache[key] = queryset
+        return queryset._clone()
+
+    def get_lookup_parameters(self):
+        """ Returns the filters built by the get_lookups from the query string
+        and by the kwargs_lookups from the view arguments. """
+        parameters = compile_lookups(self.get_lookups)(self.request.GET)
+        parameters.update(compile_lookups(self.kwargs_lookups)(self.kwargs))
+        return parameters
+
+
+    def get_plan(self, model):
+        """ Returns the SerializationPlan for the instances of ``model``, or
+        None if the response is not serialized with a fields spec (i.e. the
+        resource has no encoder, or the fields are serialized by a View).
+        """
+        if not hasattr(self, 'get_fields'):
+            return None
+        fields = self.get_fields()
+        if hasattr(fields, 'serialize'):
+            return None
+        return get_serialization_plan(model, fields)
+
+    def get_related_lookups(self, model):
+        """ Returns the (select_related, prefetch_related) paths for the
+        relations followed when serializing instances of ``model``.
+        """
+        plan = self.get_plan(model)
+        if not self.auto_related or plan is None:
+            return (), ()
+        return plan.related_lookups()
+
+    def apply_related(self, queryset):
+        """ Adds to the queryset the joins and prefetches needed to serialize
+        its items, so that their number doesn't affect the number of queries.
+        """
+        select, prefetch = self.get_related_lookups(queryset.model)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch and hasattr(queryset, 'prefetch_related'):
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    def apply_columns(self, queryset, values=False):
+        """ Restricts the queryset to the columns used by the fields spec.
+        If ``values`` is set and no relation is followed, the rows are loaded
+        with values() and model instantiation is skipped altogether.
+        Querysets already restricted by ``get_queryset()`` are left alone.
+        """
+        plan = self.get_plan(queryset.model)
+        if not self.auto_columns or plan is None \
+                or isinstance(queryset, ValuesQuerySet) \
+                or queryset.query.deferred_loading != (set(), True):
+            return queryset
+        # the cursor needs the ordering fields, which must not be serialized
+        required = tuple(name.lstrip('-') for name in self.cursor_ordering or ())
+        if values and plan.values_fields is not None and not required:
+            return queryset.values(*plan.values_fields)
+        if plan.only_fields is not None:
+            return queryset.only(*(plan.only_fields + required))
+        return queryset
+
+    def iterate_objects(self, queryset):
+        """ Returns an iterator over the queryset which doesn't cache the
+        results. Relations are prefetched one chunk of rows at a time.
+        """
+        prefetch = self.get_related_lookups(queryset.model)[1]
+        if not prefetch:
+            return queryset.iterator()
+        return chain.from_iterable(prefetch_related(chunk, prefetch)
+            for chunk in chunked(queryset.iterator(), self.chunk_size))
+
+    def prefetch_objects(self, objects, model):
+        """ Fetches in advance the m2m relations of the objects about to be
+        serialized, when QuerySet can't do it by itself (Django < 1.4).
+        """
+        prefetch = self.get_related_lookups(model)[1]
+        if prefetch and not hasattr(QuerySet, 'prefetch_related'):
+            objects = prefetch_related(list(objects), prefetch)
+        return objects
+
+
+    def get_validators(self, queryset):
+        """ Returns the (ETag, Last-Modified) pair for the resource, from
+        the ``last_modified_field``. The ETag also depends on the full path
+        and the format, so that different representations don't clash, on
+        the collection size, so that deletions are noticed, and on the
+        versions of the related models serialized with the rows.
+        """
+        field = self.last_modified_field
+        if not field:
+            return None, None
+        if self.is_collection():
+            stats = queryset.aggregate(last_modified=Max(field), count=Count('pk'))
+            last_modified, count = stats['last_modified'], stats['count']
+        else:
+            values = list(self.filter_object(queryset).values_list(field, flat=True)[:2])
+            if len(values) != 1: # let get_object() fail
+                return None, None
+            last_modified, count = values[0], 1
+        key = u'%s|%s|%s|%s|%s' % (self.request.get_full_path(),
+            getattr(self, 'format', None), last_modified, count,
+            self.get_related_versions(queryset.model))
+        etag = quote_etag(md5(key.encode('utf-8')).hexdigest())
+        if last_modified is not None:
+            last_modified = timegm(last_modified.timetuple())
+        return etag, last_modified
+
+    def get_related_versions(self, model):
+        """ Returns the versions (see restful.cache) of the models, other
+        than ``model``, whose instances are serialized with it: their changes
+        don't touch the ``last_modified_field``.
+        """
+        if not hasattr(self, 'get_cache_models'):
+            return []
+        model = _concrete_model(model)
+        related = [related for related in self.get_cache_models()
+                   if _concrete_model(related) is not model]
+        return get_versions(related) if related else []
+
+    def not_modified(self, etag, last_modified):
+        """ Whether the request's conditional headers match the validators. """
+        if self.request.META.get('HTTP_IF_NONE_MATCH') is not None:
+            return etag is not None and etag_matches(self.request, etag)
+        if_modified_since = parse_http_date_safe(
+            self.request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        return last_modified is not None and if_modified_since is not None \
+            and last_modified <= if_modified_since
+
+    def check_conditions(self, queryset):
+        """ Computes the validators, adding them to the response headers.
+        Returns a 304 response if the client's copy is up to date, else None.
+        """
+        etag, last_modified = self.get_validators(queryset)
+        if etag is not None:
+            self.response_headers['ETag'] = etag
+        if last_modified is not None:
+            self.response_headers['Last-Modified'] = http_date(last_modified)
+        if (etag or last_modified) and self.not_modified(etag, last_modified):
+            return HttpResponseNotModified()
 
 
     def get_slug_field(self):
@@ -100,7 +348,15 @@ class RestfulMixin(object):
     def paginate_queryset(self, queryset, page_size):
         """ Paginate the queryset, if needed. """
         page_size = int(page_size)
-        if page_size:
+        if page_size and self.cursor_ordering:
+            paginator = self.cursor_paginator_class(queryset, self.cursor_ordering, page_size)
+            try:
+                return paginator.page(self.request.GET.get('cursor'))
+            except InvalidPage, e:
+                raise Http404(unicode(e))
+        elif page_size and self.count_strategy == 'more':
+            return self.paginate_forward(queryset, page_size)
+        elif page_size:
             paginator = self.get_paginator(queryset, page_size, allow_empty_first_page=self.get_allow_empty())
             page = self.kwargs.get('page') or self.request.GET.get('page') or 1
             try:
@@ -124,6 +380,28 @@ class RestfulMixin(object):
         else:
             return queryset
 
+    def paginate_forward(self, queryset, page_size):
+        """ Paginate the queryset without counting it: one more item than
+        the page holds is fetched, to know whether the page is the last.
+        """
+        page = self.kwargs.get('page') or self.request.GET.get('page') or 1
+        try:
+            page_number = int(page)
+            if page_number < 1:
+                raise ValueError
+        except ValueError:
+            raise Http404(u'Invalid page (%s)' % page)
+        bottom = (page_number - 1) * page_size
+        items = list(queryset[bottom:bottom + page_size + 1])
+        if not items and page_number > 1:
+            raise Http404(u'Invalid page (%s)' % page_number)
+        return {
+            'from': bottom + 1 if items else 0,
+            'to': bottom + min(len(items), page_size),
+            'more': len(items) > page_size,
+            'items': items[:page_size],
+        }
+
     def get_paginate_by(self, queryset=None):
         """
         Get the number of items to paginate by, or ``None`` for no pagination.
@@ -139,6 +417,10 @@ class RestfulMixin(object):
         """
         Return an instance of the paginator for this view.
         """
+        if self.count_strategy in self.count_paginator_classes:
+            return self.count_paginator_classes[self.count_strategy](queryset, per_page,
+                orphans=orphans, allow_empty_first_page=allow_empty_first_page,
+                timeout=self.count_cache_timeout)
         return self.paginator_class(queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page)
 
     def get_allow_empty(self):
@@ -149,62 +431,361 @@ class RestfulMixin(object):
         return self.allow_empty
 
 
-    def update_attrs(self, instance, data):
+    def get_attr_fields(self, data):
+        """ Returns the (key, field) pairs of the model fields set by ``data``,
+        where the key is either the field name or its attname.
+        """
         opts = self.model._meta
         _fields = dict((field.name, field) 
                 for field in opts.fields
                 if field.name in data
-                and field.name != instance._meta.pk.name)
+                and field.name != opts.pk.name)
         _fields.update(dict((field.attname, field) 
                 for field in opts.fields
                 if field.attname in data
-                and field.name != instance._meta.pk.name))
-        for key, field in _fields.items():
-            if field.rel:
-                to = field.rel.to
-                value = data[key]
-                if isinstance(value, dict) and 'id' in value:
-                    value = value['id']
-                if isinstance(value, basestring) and '.' in value and to == ContentType:
-                    setattr(instance, key, ContentType.objects.get_by_natural_key(*value.split('.')))
-                    continue
-                elif isinstance(value, (tuple, list)) and hasattr(to.objects, 'get_by_natural_key'):
+                and field.name != opts.pk.name))
+        return _fields.items()
+
+    def get_reference(self, field, value):
+        """ Normalizes the value of a related field into a ('pk', value) or a
+        ('natural', key) reference, or None for no related object.
+        """
+        to = field.rel.to
+        if isinstance(value, dict) and 'id' in value:
+            value = value['id']
+        if value is None:
+            return None
+        if isinstance(value, basestring) and '.' in value and to == ContentType:
+            return ('natural', tuple(value.split('.', 1)))
+        elif isinstance(value, (tuple, list)) and hasattr(to._default_manager, 'get_by_natural_key'):
+            return ('natural', tuple(value))
+        else:
+            return ('pk', to._meta.get_field(field.rel.field_name).to_python(value))
+
+    def resolve_references(self, items):
+        """ Fetches the objects referenced by the related fields of all the
+        items, with one query per related model (natural keys are looked up
+        once each, ContentTypes through their cache). Returns a map from
+        (model, field name, reference) to object, missing the unknown ones.
+        """
+        wanted = defaultdict(set)
+        for data in items:
+            for key, field in self.get_attr_fields(data):
+                if field.rel:
                     try:
-                        setattr(instance, key, to.objects.get_by_natural_key(*value))
-                    except:
-                        pass
-                else:
+                        reference = self.get_reference(field, data[key])
+                    except Exception: # reported by update_attrs()
+                        continue
+                    if reference is not None:
+                        wanted[field.rel.to, field.rel.field_name].add(reference)
+        resolved = {}
+        for (to, to_field), references in wanted.iteritems():
+            values = [value for kind, value in references if kind == 'pk']
+            if values:
+                # the value of the target field (e.g. parent_ptr, a relation itself)
+                attname = to._meta.get_field(to_field).attname
+                for obj in to._default_manager.filter(**{to_field + '__in': values}):
+                    resolved[to, to_field, ('pk', getattr(obj, attname))] = obj
+            for kind, value in references:
+                if kind == 'natural':
                     try:
-                        setattr(instance, key, to.objects.get(pk=value))
-                    except:
+                        resolved[to, to_field, (kind, value)] = \
+                            to._default_manager.get_by_natural_key(*value)
+                    except ObjectDoesNotExist:
                         pass
+        return resolved
+
+    def update_attrs(self, instance, data, references=None):
+        """ Sets the attributes of ``instance`` from ``data``. References to
+        related objects are looked up with resolve_references(), unless the
+        map is given (e.g. built once for a whole batch). Unknown references
+        raise ObjectDoesNotExist.
+        """
+        fields = self.get_attr_fields(data)
+        if references is None:
+            references = self.resolve_references([data])
+        for key, field in fields:
+            if field.rel:
+                reference = self.get_reference(field, data[key])
+                if reference is None:
+                    setattr(instance, field.name, None)
+                    continue
+                try:
+                    value = references[field.rel.to, field.rel.field_name, reference]
+                except KeyError:
+                    raise ObjectDoesNotExist(u"No %s matching %r for field '%s'."
+                        % (field.rel.to._meta.verbose_name, reference[1], key))
+                setattr(instance, field.name, value)
             else:
-                setattr(instance, key, data[key])
+                value = data[key]
+                if isinstance(value, basestring):
+                    # text decoders (e.g. XML) yield every value as a string
+                    value = field.to_python(value)
+                setattr(instance, key, value)
+        return instance
+
+
+    def has_save_hooks(self):
+        """ Whether saving instances of the model runs anything besides the
+        query: the model overrides save(), or there are save signal receivers.
+        """
+        return self.model.save.im_func is not Model.save.im_func \
+            or _has_receivers(pre_save, self.model) \
+            or _has_receivers(post_save, self.model)
+
+    def needs_instance(self, data):
+        """ Whether updating an object with ``data`` takes loading and
+        saving the instance: the model has save hooks or fields which change
+        on save (e.g. auto_now), or data sets m2m relations.
+        """
+        opts = self.model._meta
+        return self.has_save_hooks() \
+            or not all(_plain_pre_save(field) for field in opts.fields) \
+            or any(field.name in data for field in opts.many_to_many)
+
+    def update_object(self, data):
+        """ Updates the object with the fields in ``data``, writing only
+        their columns: with a single UPDATE, when the instance isn't needed,
+        else by saving it with update_fields (or whole, on Django < 1.5).
+        Returns the updated object. Raises Http404 if there is none.
+        """
+        fields = self.get_attr_fields(data)
+        if not self.needs_instance(data):
+            # the values (and references) are resolved on an unsaved instance
+            instance = self.update_attrs(self.model(), data)
+            if fields:
+                self.filter_object(self.get_queryset()).update(**dict(
+                    (field.name, getattr(instance, field.name))
+                    for key, field in fields))
+                invalidate(self.model) # no post_save is sent
+            queryset = self.apply_columns(self.apply_related(self.get_queryset()))
+            instance = self.get_object(queryset)
+            self.prefetch_objects([instance], queryset.model)
+            return instance
+        instance = self.get_object()
+        self.update_attrs(instance, data)
+        if not _update_fields:
+            instance.save()
+        elif fields:
+            # fields changing on save (e.g. auto_now) are only written if listed
+            names = set(field.name for key, field in fields)
+            names.update(field.name for field in self.model._meta.fields
+                         if not field.primary_key and not _plain_pre_save(field))
+            instance.save(update_fields=list(names))
+        self.save_m2m(instance, data)
         return instance
 
+    def get_m2m_pks(self, field, values):
+        """ Returns the set of related pks in the value of a m2m field: a list
+        of pks, or of objects with an 'id'.
+        """
+        to_python = field.rel.to._meta.pk.to_python
+        return set(to_python(value['id'] if isinstance(value, dict) else value)
+                   for value in values or ())
+
+    def insert_m2m(self, field, pairs, using):
+        """ Inserts the (source pk, target pk) rows into the field's through
+        table, with batched INSERTs when the manager supports bulk_create().
+        """
+        through = field.rel.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+        if _is_symmetrical(field):
+            pairs = set(pairs)
+            pairs.update([(target_pk, source_pk) for source_pk, target_pk in pairs])
+        rows = [through(**{source: source_pk, target: target_pk})
+                for source_pk, target_pk in pairs]
+        manager = through._default_manager.db_manager(using)
+        if hasattr(manager, 'bulk_create'):
+            manager.bulk_create(rows, batch_size=self.bulk_batch_size)
+        else:
+            for row in rows:
+                row.save(force_insert=True, using=using)
 
     def save_m2m(self, instance, data):
+        """ Sets the m2m relations listed in ``data``. The current pks are
+        read with a single query, and only the through rows that change are
+        deleted or inserted. Unknown pks raise ObjectDoesNotExist.
+        """
         opts = self.model._meta
+        using = router.db_for_write(self.model, instance=instance)
         for field in opts.many_to_many:
             if field.name in data and field.rel:
+                if not field.rel.through._meta.auto_created:
+                    log.debug("Cannot set %s, it has an intermediary model." % field.name)
+                    continue
                 to = field.rel.to
-                pks = data[field.name]
-                if pks:
-                    if isinstance(pks[0], dict):
-                        pks = [pk['id'] for pk in pks]
-                    try:
-                        getattr(instance, field.name).clear()
-                        getattr(instance, field.name).add(*to.objects.in_bulk(pks))
-                    except Exception, e:
-                        log.debug(e)
+                through = field.rel.through._default_manager.db_manager(using)
+                source = field.m2m_field_name()
+                target = field.m2m_reverse_field_name()
+                wanted = self.get_m2m_pks(field, data[field.name])
+                current = set(through.filter(**{source: instance.pk})
+                              .values_list(target, flat=True))
+                removed, added = current - wanted, wanted - current
+                if added:
+                    found = set(to._default_manager.db_manager(using)
+                                .filter(pk__in=added).values_list('pk', flat=True))
+                    if found != added:
+                        raise ObjectDoesNotExist(u"No %s matching %r for field '%s'."
+                            % (to._meta.verbose_name, sorted(added - found), field.name))
+                signal = dict(sender=field.rel.through, instance=instance,
+                              reverse=False, model=to, using=using)
+                if removed:
+                    m2m_changed.send(action='pre_remove', pk_set=removed, **signal)
+                    through.filter(**{source: instance.pk,
+                                      target + '__in': removed}).delete()
+                    if _is_symmetrical(field):
+                        through.filter(**{source + '__in': removed,
+                                          target: instance.pk}).delete()
+                    m2m_changed.send(action='post_remove', pk_set=removed, **signal)
+                if added:
+                    m2m_changed.send(action='pre_add', pk_set=added, **signal)
+                    self.insert_m2m(field, [(instance.pk, pk) for pk in added], using)
+                    m2m_changed.send(action='post_add', pk_set=added, **signal)
+
+
+    def get_bulk_key(self, instances):
+        """ Returns a unique field of the model set, to distinct values, on
+        all the instances, by which their primary keys can be selected back
+        once inserted (the primary key itself if they have one), or None.
+        """
+        for field in self.model._meta.local_fields:
+            if field.unique and not field.rel:
+                values = [getattr(instance, field.attname) for instance in instances]
+                if None not in values and len(set(values)) == len(values):
+                    return field
+        return None
+
+    def bulk_insert(self, instances, items):
+        """ Inserts the new instances, with batched INSERTs when the manager
+        supports bulk_create(), saving runs no hooks (which bulk_create()
+        skips) and the instances have a unique key: the primary keys of the
+        rows, which the results and the m2m relations need, are selected by
+        it in the same transaction. Otherwise the instances are saved one by
+        one.
+        """
+        manager = self.model._default_manager
+        key = None
+        if hasattr(manager, 'bulk_create') and not self.model._meta.parents \
+                and not self.has_save_hooks():
+            key = self.get_bulk_key(instances)
+        if key is None:
+            for instance in instances:
+                instance.save()
+            return
+        manager.bulk_create(instances, batch_size=self.bulk_batch_size)
+        invalidate(self.model) # no post_save is sent
+        if not key.primary_key:
+            values = [getattr(instance, key.attname) for instance in instances]
+            pks = dict(self.model._base_manager.filter(**{key.name + '__in': values})
+                       .values_list(key.attname, 'pk'))
+            for instance, value in zip(instances, values):
+                instance.pk = pks[value]
+
+    def bulk_insert_m2m(self, instances, items):
+        """ Adds the m2m relations of newly created instances, inserting the
+        rows of each through table at once. The m2m_changed signal is sent
+        as Manager.add() would.
+        """
+        using = router.db_for_write(self.model)
+        for field in self.model._meta.many_to_many:
+            added = [(instance, self.get_m2m_pks(field, item.get(field.name)))
+                     for instance, item in zip(instances, items)]
+            added = [(instance, pks) for instance, pks in added if pks]
+            if not added:
+                continue
+            self.insert_m2m(field, [(instance.pk, pk) for instance, pks in added
+                                    for pk in pks], using)
+            for instance, pk_set in added:
+                m2m_changed.send(sender=field.rel.through, action='post_add',
+                                 instance=instance, reverse=False,
+                                 model=field.rel.to, pk_set=pk_set, using=using)
+
+    def bulk_write(self, items, create=True):
+        """ Creates all the items (or updates them, matching their primary key
+        with the collection) in a single transaction. Returns the per-item
+        results; if any item can't be applied, nothing is written and the
+        response status is 400.
+        The items are validated and written bulk_batch_size at a time, and
+        only their results are kept: ``items`` can be an iterator over a
+        large request body.
+        """
+        items = iter(items)
+        results, failed = [], False
+        try:
+            with atomic(using=router.db_for_write(self.model)):
+                for chunk in chunked(items, self.bulk_batch_size):
+                    instances = self.bulk_prepare(chunk, create, results)
+                    # after a failure, the remaining items are just validated
+                    failed = failed or len(instances) < len(chunk)
+                    if failed:
+                        continue
+                    if create:
+                        self.bulk_insert(instances, chunk)
+                        self.bulk_insert_m2m(instances, chunk)
+                    else:
+                        for instance, item in zip(instances, chunk):
+                            instance.save()
+                            self.save_m2m(instance, item)
+                    for result, instance in zip(results[-len(chunk):], instances):
+                        result['id'] = instance.pk
+                if failed:
+                    raise _Rollback()
+        except _Rollback:
+            self.response_status = 400
+            return results
+        except Exception, e:
+            # the whole transaction failed, so did every item
+            self.response_status = 400
+            count = len(results) + sum(1 for item in items)
+            return [{'status': 400, 'error': unicode(e)} for i in xrange(count)]
+        self.response_status = 201 if create else 200
+        return results
+
+    def bulk_prepare(self, items, create, results):
+        """ Builds (or fetches, when updating) the instances of the items and
+        applies them their attributes. Appends the result of each item to
+        ``results`` and returns the instances of the valid ones.
+        """
+        pk_name = self.model._meta.pk.name
+        if not create:
+            pks = [item.get(pk_name, item.get('id')) for item in items
+                   if isinstance(item, dict)]
+            existing = self.get_queryset().in_bulk([pk for pk in pks if pk is not None])
+        instances = []
+        references = self.resolve_references([item for item in items
+                                              if isinstance(item, dict)])
+        for item in items:
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError('Items must be objects.')
+                if create:
+                    instance = self.model()
                 else:
-                    getattr(instance, field.name).clear()
+                    pk = self.model._meta.pk.to_python(item.get(pk_name, item.get('id')))
+                    if pk not in existing:
+                        results.append({'status': 404, 'error': u'Not found.'})
+                        continue
+                    instance = existing[pk]
+                self.update_attrs(instance, item, references)
+                instances.append(instance)
+                results.append({'status': 201 if create else 200})
+            except Exception, e:
+                results.append({'status': 400, 'error': unicode(e)})
+        return instances
+
 
+class _Rollback(Exception):
+    """ Raised to roll back the transaction of a failed bulk write. """
 
 
 
 class BaseRestfulResource(RestfulMixin, View):
 
+    # Django < 1.5 doesn't dispatch PATCH requests
+    http_method_names = [name for name in View.http_method_names if name != 'patch'] \
+        + ['patch']
+
     @classmethod
     def as_view(cls, *args, **initkwargs):
         """ Adding to the super, use the positional args to allow http_method_names """
@@ -213,43 +794,79 @@ class BaseRestfulResource(RestfulMixin, View):
         return super(BaseRestfulResource, cls).as_view(**initkwargs)
 
 
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in ('PUT', 'PATCH', 'POST', 'DELETE'):
+            with get_timing(self).phase('write'):
+                return super(BaseRestfulResource, self).dispatch(request, *args, **kwargs)
+        return super(BaseRestfulResource, self).dispatch(request, *args, **kwargs)
+
+
     def get(self, request, *args, **kwargs):
+        timing = get_timing(self)
+        with timing.phase('query'):
+            queryset = self.get_queryset()
+            not_modified = self.check_conditions(queryset)
+        if not_modified is not None:
+            return not_modified
         if self.is_collection():
             self.object = None
-            self.object_list = self.get_queryset()
+            self.object_list = self.apply_columns(self.apply_related(queryset), values=True)
             allow_empty = self.get_allow_empty()
-            if not allow_empty and len(self.object_list) == 0:
+            if not allow_empty and not self.object_list.exists():
                 raise Http404(u"Empty list and '%s.allow_empty' is False."
                           % self.__class__.__name__)
-            return self.paginate_queryset(self.object_list, self.get_paginate_by())
+            model = self.object_list.model
+            with timing.phase('paginate'):
+                page = self.paginate_queryset(self.object_list, self.get_paginate_by())
+            # the page is evaluated here, not lazily while serializing
+            if isinstance(page, dict):
+                with timing.phase('fetch'):
+                    page['items'] = list(self.prefetch_objects(page['items'], model))
+                return page
+            if getattr(self, 'streaming', False):
+                return self.iterate_objects(page)
+            with timing.phase('fetch'):
+                return list(self.prefetch_objects(page, model))
         else:
-            self.object = self.get_object()
-            self.object_list = None
+            queryset = self.apply_columns(self.apply_related(queryset))
+            with timing.phase('fetch'):
+                self.object = self.get_object(queryset)
+                self.object_list = None
+                self.prefetch_objects([self.object], queryset.model)
             return self.object
 
 
     def put(self, request, *args, **kwargs):
+        if isinstance(self.data, (list, Iterator)) and self.is_collection():
+            return self.bulk_write(self.data, create=False)
+        return self.patch(request, *args, **kwargs)
+
+
+    def patch(self, request, *args, **kwargs):
+        if not isinstance(self.data, dict):
+            return HttpResponseBadRequest()
         try:
-            instance = self.get_object()
-            self.update_attrs(instance, self.data)
-            instance.save()
-            self.save_m2m(instance, self.data)
-            return instance
+            with atomic(using=router.db_for_write(self.model)):
+                return self.update_object(self.data)
         except Http404:
             return HttpResponseBadRequest()
         except Exception, e:
-            return HttpResponseBadRequest(e)
+            return HttpResponseBadRequest(unicode(e))
 
 
     def post(self, request, *args, **kwargs):
+        if isinstance(self.data, (list, Iterator)):
+            return self.bulk_write(self.data, create=True)
         try:
-            new_instance = self.model()
-            self.update_attrs(new_instance, self.data)
-            new_instance.save()
-            self.save_m2m(new_instance, self.data)
+            # a failure on the m2m relations must not leave the instance saved
+            with atomic(using=router.db_for_write(self.model)):
+                new_instance = self.model()
+                self.update_attrs(new_instance, self.data)
+                new_instance.save()
+                self.save_m2m(new_instance, self.data)
             return new_instance
         except Exception, e:
-            return HttpResponseBadRequest(e)
+            return HttpResponseBadRequest(unicode(e))
 
     def delete(self, request, *args, **kwargs):
         try:
@@ -260,10 +877,9 @@ class BaseRestfulResource(RestfulMixin, View):
 
 
 
-class RestfulResource(JSONRequestDecoder, XMLRequestDecoder,
-    JSONResponseEncoder, XMLResponseEncoder, BaseRestfulResource):
-    def get_default_format(self):
-        return 'json'
+class RestfulResource(JSONRequestDecoder, XMLRequestDecoder, MsgPackRequestDecoder,
+    JSONResponseEncoder, XMLResponseEncoder, MsgPackResponseEncoder, BaseRestfulResource):
+    pass
 
 
 
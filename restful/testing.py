@@ -0,0 +1,62 @@
+'''
+Helpers for the tests of the projects using restful.
+
+QueryBudgetMixin adds assertions on the number of queries run by the
+resources, to TestCase classes: a collection which is serialized with a
+constant number of queries stays so, whatever the page size, while a
+per-row query makes the count grow with the page.
+'''
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+
+
+def count_queries(function, *args, **kwargs):
+    """ Calls function, returning its result and the list of the SQL of the
+    queries it ran (on the default database). Requests dispatched through
+    the test client don't reset the log meanwhile.
+    """
+    use_debug_cursor, connection.use_debug_cursor = connection.use_debug_cursor, True
+    request_started.disconnect(reset_queries)
+    start = len(connection.queries)
+    try:
+        result = function(*args, **kwargs)
+        return result, [query['sql'] for query in connection.queries[start:]]
+    finally:
+        request_started.connect(reset_queries)
+        connection.use_debug_cursor = use_debug_cursor
+
+
+class QueryBudgetMixin(object):
+    """ A mixin for TestCase classes. """
+
+    def _check_query_budget(self, budget, queries):
+        if len(queries) > budget:
+            self.fail('%d queries run, over the budget of %d:\n%s'
+                      % (len(queries), budget, '\n'.join(queries)))
+
+    def assertQueryBudget(self, budget, function, *args, **kwargs):
+        """ Asserts that calling function, e.g. a view on a request, runs at
+        most budget queries. Returns what the function returns.
+        """
+        result, queries = count_queries(function, *args, **kwargs)
+        self._check_query_budget(budget, queries)
+        return result
+
+    def assertPageQueryBudget(self, budget, view, make_request, sizes=(1, 10, 50)):
+        """ Asserts that GETting pages of each size (the ``items`` parameter
+        of paginated resources) runs at most budget queries, and the same
+        number for all sizes. make_request(query_string) returns the request
+        passed to the view; the collection should hold more rows than the
+        largest size.
+        """
+        counts = []
+        for size in sizes:
+            response, queries = count_queries(view, make_request('items=%d' % size))
+            self.assertEqual(response.status_code, 200)
+            self._check_query_budget(budget, queries)
+            counts.append(queries)
+        lengths = [len(queries) for queries in counts]
+        if len(set(lengths)) > 1:
+            self.fail('The queries grow with the page size (%s):\n%s' % (
+                ', '.join('%d for %d items' % item for item in zip(lengths, sizes)),
+                '\n'.join(counts[-1])))
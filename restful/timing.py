@@ -0,0 +1,201 @@
+'''
+Per-phase timing of the requests dispatched by the resources.
+
+When the ``timing`` attribute of a resource is set, each request records
+the wall time, and the number and time of the database queries, of its
+phases: 'decode', 'query', 'paginate', 'fetch', 'write', 'serialize',
+'render' and 'compress' (those which apply). At the end, the phases_timed
+signal is sent, so that exporters (statsd, Prometheus...) can be plugged in
+as receivers, and with ``timing_header`` the response carries them in a
+Server-Timing header.
+
+The same records catch N+1 queries: with ``detect_repeated_queries``, the
+queries run while serializing and rendering are grouped by shape (their
+SQL without the literals), and a shape repeated for each row is reported,
+as a warning or as a RepeatedQueries exception.
+
+Streamed responses are serialized and rendered after the request is
+dispatched, so those phases are not recorded for them.
+'''
+from django.db import connections
+from django.dispatch import Signal
+from functools import wraps
+from logging import getLogger
+from timeit import default_timer
+import re
+
+
+log = getLogger('restful.timing')
+
+# Sent after a timed request, by the class of the resource.
+phases_timed = Signal(providing_args=['resource', 'request', 'response', 'timing'])
+
+# The phases where any repeated query shape is a sign of per-row queries.
+ROW_PHASES = ('serialize', 'render')
+
+
+class RepeatedQueries(Exception):
+    """ Raised when a query shape is repeated while serializing. """
+
+
+class Phase(object):
+    """ A timed phase: its duration and the count and duration of the
+    queries it executed, in seconds. """
+    def __init__(self, name):
+        self.name = name
+        self.duration = self.query_duration = 0.0
+        self.queries = 0
+        self.sql = []
+
+    def __repr__(self):
+        return '<Phase %s: %.3fs, %d queries>' % (self.name, self.duration, self.queries)
+
+
+class Timing(object):
+    """ The phases of a request, in the order they started. Queries are
+    logged by the debug cursors for the whole request.
+    """
+    def __init__(self):
+        self.phases = []
+        self.start = default_timer()
+        self.duration = None
+        self._debug_cursors = [(connection, connection.use_debug_cursor)
+                               for connection in connections.all()]
+        for connection, use_debug_cursor in self._debug_cursors:
+            connection.use_debug_cursor = True
+
+    def phase(self, name):
+        return _PhaseContext(self, name)
+
+    def stop(self):
+        self.duration = default_timer() - self.start
+        for connection, use_debug_cursor in self._debug_cursors:
+            connection.use_debug_cursor = use_debug_cursor
+
+    @property
+    def queries(self):
+        return sum(phase.queries for phase in self.phases)
+
+    @property
+    def query_duration(self):
+        return sum(phase.query_duration for phase in self.phases)
+
+    def header(self):
+        """ Returns the value of the Server-Timing header. """
+        metrics = ['%s;dur=%.1f' % (phase.name, phase.duration * 1000)
+                   for phase in self.phases]
+        metrics.append('db;dur=%.1f;desc="%d queries"' % (self.query_duration * 1000,
+                                                        self.queries))
+        if self.duration is not None:
+            metrics.append('total;dur=%.1f' % (self.duration * 1000))
+        return ', '.join(metrics)
+
+    def repeated_queries(self, phases=ROW_PHASES, threshold=2):
+        """ Returns the (shape, count) pairs of the query shapes run at
+        least threshold times during the given phases, most repeated first.
+        """
+        counts = {}
+        for phase in self.phases:
+            if phase.name in phases:
+                for sql in phase.sql:
+                    shape = query_shape(sql)
+                    counts[shape] = counts.get(shape, 0) + 1
+        return sorted([(shape, count) for shape, count in counts.iteritems()
+                       if count >= threshold], key=lambda item: -item[1])
+
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_value_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def query_shape(sql):
+    """ Returns the SQL with its literal values, and lists of them, replaced
+    by placeholders, so that queries differing only by values compare equal.
+    """
+    return _value_lists.sub('(...)', _literals.sub('?', sql))
+
+
+def check_repeated_queries(resource, request, timing):
+    """ Reports the query shapes repeated while serializing the response of
+    the resource, as its ``detect_repeated_queries`` attribute says: by a
+    warning ('warn') or by raising RepeatedQueries ('raise').
+    """
+    repeated = timing.repeated_queries()
+    if not repeated:
+        return
+    message = '%s %s (%s) runs per-row queries: %s' % (request.method, request.path,
+        resource.__class__.__name__,
+        '; '.join('%d x %s' % (count, shape) for shape, count in repeated))
+    if resource.detect_repeated_queries == 'raise':
+        raise RepeatedQueries(message)
+    log.warning(message)
+
+
+def _query_log():
+    return [connection.queries for connection in connections.all()]
+
+class _PhaseContext(object):
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.phase = Phase(name)
+
+    def __enter__(self):
+        self.logs = _query_log()
+        self.lengths = [len(log) for log in self.logs]
+        self.start = default_timer()
+        return self.phase
+
+    def __exit__(self, *exc_info):
+        phase = self.phase
+        phase.duration = default_timer() - self.start
+        for log, length in zip(self.logs, self.lengths):
+            queries = log[length:]
+            phase.queries += len(queries)
+            phase.query_duration += sum(float(query['time']) for query in queries)
+            phase.sql.extend(query['sql'] for query in queries)
+        self.timing.phases.append(phase)
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return None
+    def __exit__(self, *exc_info):
+        pass
+
+class _NullTiming(object):
+    """ Stands for the Timing of requests which are not timed. """
+    _context = _NullContext()
+    def phase(self, name):
+        return self._context
+
+NULL_TIMING = _NullTiming()
+
+
+def get_timing(resource):
+    """ Returns the Timing of the request being dispatched by resource (a
+    no-op one if it is not timed). """
+    return resource.__dict__.get('_timing', NULL_TIMING)
+
+
+def timed(dispatch):
+    """ Decorates a dispatch() method: the outermost decorated dispatch() of
+    a resource whose ``timing`` or ``detect_repeated_queries`` attribute is
+    set times the request.
+    """
+    @wraps(dispatch)
+    def timed_dispatch(self, request, *args, **kwargs):
+        if '_timing' in self.__dict__ or not (getattr(self, 'timing', False)
+                or getattr(self, 'detect_repeated_queries', None)):
+            return dispatch(self, request, *args, **kwargs)
+        self._timing = timing = Timing()
+        try:
+            response = dispatch(self, request, *args, **kwargs)
+        finally:
+            timing.stop()
+        if getattr(self, 'detect_repeated_queries', None):
+            check_repeated_queries(self, request, timing)
+        if getattr(self, 'timing_header', False):
+            response['Server-Timing'] = timing.header()
+        phases_timed.send(sender=self.__class__, resource=self, request=request,
+                          response=response, timing=timing)
+        return response
+    return timed_dispatch
@@ -4,13 +4,18 @@ Created on Feb 11, 2011
 @author: saverio
 '''
 from collections import namedtuple, Mapping, Iterable
+from contextlib import contextmanager
 from decimal import Decimal
+from functools import partial
+from operator import attrgetter
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
 from django.db.models import Model, Manager, ForeignKey, ManyToManyField
 from django.http import HttpResponse
 from django.utils.encoding import smart_unicode
 from numbers import Number
 import collections
+import datetime
 import inspect
 import itertools
 
@@ -31,6 +36,10 @@ def smart_bool(value):
     return False
 
 def smart_contenttype(value):
+    """ Converts an 'app_label.model' natural key, or just a model name, to
+    its ContentType, or None. Natural keys are taken from the ContentType
+    cache when it holds them.
+    """
     try:
         if '.' in value:
             return ContentType.objects.get_by_natural_key(*value.split('.', 1))
@@ -75,6 +84,405 @@ class LookupParameter(namedtuple('LookupParameter', ['parameter', 'conversion',
             return ()
 
 
+# The functions compiled by compile_lookups(), keyed by the lookups; the
+# cache is cleared when it holds lookup_pipelines_size of them.
+_lookup_pipelines = {}
+lookup_pipelines_size = 256
+
+def compile_lookups(lookups):
+    """ Compiles a sequence of LookupParameters into a single function, which
+    takes a mapping and returns the dict of all their filters, the same as
+    ``dict(chain(*(lookup(mapping) for lookup in lookups)))``.
+    Functions are compiled once for each sequence of lookups.
+    """
+    lookups = tuple(lookups)
+    try:
+        return _lookup_pipelines[lookups]
+    except KeyError:
+        pass
+    except TypeError: # unhashable conversions, don't cache
+        return _compile_lookups(lookups)
+    if len(_lookup_pipelines) >= lookup_pipelines_size:
+        _lookup_pipelines.clear()
+    _lookup_pipelines[lookups] = pipeline = _compile_lookups(lookups)
+    return pipeline
+
+def _compile_lookups(lookups):
+    # any other callable is kept as it is, in place of the parameter
+    steps = tuple((lookup.parameter, lookup.field,
+                   None if lookup.conversion is identity else lookup.conversion,
+                   lookup.split) if isinstance(lookup, LookupParameter)
+                  else (lookup, None, None, None) for lookup in lookups)
+    def build_filter(mapping):
+        parameters = {}
+        for parameter, field, conversion, split in steps:
+            if field is None:
+                parameters.update(parameter(mapping))
+                continue
+            if parameter not in mapping:
+                continue
+            value = mapping[parameter]
+            if conversion or split:
+                try:
+                    if split:
+                        value = [conversion(v) if conversion else v
+                                 for v in value.split(split)]
+                    else:
+                        value = conversion(value)
+                except:
+                    value = None
+            parameters[field] = value
+        return parameters
+    return build_filter
+
+
+# Marks an extra attribute which could not be found on an instance.
+_missing = object()
+
+# Values of these types serialize to themselves (see smart_unicode's
+# strings_only), so the converters can skip the whole type dispatch.
+_passthrough_types = frozenset((type(None), bool, int, long, float, unicode,
+    datetime.datetime, datetime.date, datetime.time))
+
+# The instance attribute holding m2m relations fetched by prefetch_related().
+_prefetch_cache = '_restful_prefetched'
+
+# The cache of compiled plans, keyed by (model class, fields spec). The
+# specs can be chosen by the clients (see sparse_fields_marker), so the
+# cache is cleared when it holds serialization_plans_size plans.
+_serialization_plans = {}
+serialization_plans_size = 512
+
+
+def _extend_fields(fields):
+    """ Transforms a fields spec into a dict mapping every name to its
+    subfields spec, or None. Mappings are assumed to be already extended.
+    """
+    if isinstance(fields, Mapping):
+        return dict(fields)
+    extended_fields = {}
+    for field_spec in fields or ():
+        if isinstance(field_spec, tuple):
+            extended_fields[field_spec[0]] = field_spec[1]
+        else:
+            extended_fields[field_spec] = None
+    return extended_fields
+
+
+def _spec_key(fields):
+    """ A hashable key for a fields spec. Raises TypeError if the spec
+    contains unhashable parts.
+    """
+    if fields is None or isinstance(fields, tuple):
+        return fields or ()
+    if isinstance(fields, Mapping):
+        return frozenset(fields.iteritems())
+    key = tuple(fields)
+    hash(key)
+    return key
+
+
+def _convert_scalar(value):
+    if value.__class__ in _passthrough_types:
+        return value
+    return _serialize_any(value)
+
+
+def _attribute_getter(name):
+    """ A getter for extra attributes and methods listed in a fields spec. """
+    def getter(instance):
+        try:
+            attribute = getattr(instance, name)
+        except:
+            print "Attribute %s not found in %s." % (name, instance)
+            return _missing # fail??
+        try:
+            return attribute()
+        except:
+            return attribute
+    return getter
+
+
+def _stock_to_python(field):
+    """ Whether the field converts the database values as Django's own
+    fields do, so that values() loads what the instances would hold: custom
+    fields (e.g. with SubfieldBase) convert them in their to_python().
+    """
+    for klass in type(field).__mro__:
+        if 'to_python' in klass.__dict__:
+            return klass.__module__.startswith('django.db.models.')
+    return True
+
+
+def _m2m_getter(attname):
+    def getter(instance):
+        if instance.pk is None:
+            return []
+        try:
+            return instance.__dict__[_prefetch_cache][attname]
+        except KeyError:
+            return getattr(instance, attname).all()
+    return getter
+
+
+def _related_converter(model, fields):
+    """ A converter for instances of a related model. The related plan is
+    compiled on first use, as compiling it eagerly would never terminate
+    on self-referencing models.
+    """
+    if hasattr(fields, 'serialize'):
+        return partial(_serialize_any, fields=fields)
+    compiled = []
+    def converter(value):
+        if value is None:
+            return None
+        if value.__class__ is not model:
+            return _serialize_model(value, fields)
+        if not compiled:
+            compiled.append(get_serialization_plan(model, fields))
+        return compiled[0].serialize(value)
+    return converter
+
+
+def _many_converter(model, fields):
+    convert = _related_converter(model, fields)
+    return lambda values: [convert(value) for value in values]
+
+
+
+class SerializationPlan(object):
+    """ The compiled form of a fields spec for a given model class.
+
+    The spec is parsed and matched against the model's ``_meta`` once, into
+    a flat list of ``(name, getter, converter)`` accessors: the getter
+    extracts the raw value from an instance (as returned by
+    ``model_to_dict()``), the converter turns it into its serialized form.
+    Use ``get_serialization_plan()`` to obtain cached instances.
+
+    A plan can be used as a fields spec itself, since it implements
+    ``serialize()``.
+    """
+    def __init__(self, model, fields=()):
+        self.model = model
+        self.fields = _extend_fields(fields)
+        self.accessors = []
+        self.natural_key = None
+        # the fields to load with only() and values(), or None when whole
+        # instances are needed
+        self.only_fields = None
+        self.values_fields = None
+        self._related_lookups = None
+        if tuple(self.fields) in (('natural_key',), ('natural.key',)):
+            self.natural_key = tuple(self.fields)[0]
+        else:
+            self._compile()
+
+    def _compile(self):
+        fields = self.fields
+        opts = self.model._meta
+        found = set()
+        columns, flat = [], True
+        for f in opts.fields + opts.many_to_many:
+            if fields and not f.name in fields:
+                continue
+            found.add(f.name)
+            subfields = fields.get(f.name)
+            if isinstance(f, ManyToManyField):
+                flat = False
+            else:
+                columns.append(f.name)
+                flat = flat and subfields is None
+            if isinstance(f, ManyToManyField):
+                getter = _m2m_getter(f.attname)
+                converter = _many_converter(f.rel.to, subfields)
+            elif fields and isinstance(f, ForeignKey) and subfields is not None:
+                getter = attrgetter(f.name)
+                converter = _related_converter(f.rel.to, subfields)
+            elif subfields is None:
+                getter = attrgetter(f.attname)
+                converter = _convert_scalar
+            else:
+                getter = attrgetter(f.attname)
+                converter = partial(_serialize_any, fields=subfields)
+            self.accessors.append((f.name, getter, converter))
+        # add extra attributes/method
+        for name in fields:
+            if name not in found:
+                self.accessors.append((name, _attribute_getter(name),
+                    partial(_serialize_any, fields=fields[name])))
+        # extra attributes may use any column, so only explicit field lists
+        # can be pruned
+        if fields and found.issuperset(fields):
+            self.only_fields = tuple(columns) or (opts.pk.name,)
+            if flat and all(_stock_to_python(opts.get_field(name)) for name in columns):
+                self.values_fields = tuple(columns)
+
+    def related_lookups(self):
+        """ Returns a pair with the paths to be passed to select_related() and
+        prefetch_related(), to fetch in advance all the relations followed
+        by the plan.
+        """
+        if self._related_lookups is None:
+            select, prefetch = [], []
+            _collect_related(self.model, self.fields, '', False, (self.model,),
+                             select, prefetch)
+            self._related_lookups = (tuple(select), tuple(prefetch))
+        return self._related_lookups
+
+    def related_models(self):
+        """ Returns the models whose instances are serialized by the plan:
+        its own model and those reached through the related lookups.
+        """
+        models = [self.model]
+        for lookup in itertools.chain(*self.related_lookups()):
+            model = self.model
+            for name in lookup.split('__'):
+                model = model._meta.get_field(name).rel.to
+            if model not in models:
+                models.append(model)
+        return models
+
+    def to_dict(self, instance):
+        """ Returns the raw values of ``instance``, see ``model_to_dict()``. """
+        if self.natural_key == 'natural_key':
+            return instance.natural_key()
+        elif self.natural_key == 'natural.key':
+            return '.'.join(instance.natural_key())
+        data = {}
+        for name, getter, converter in self.accessors:
+            value = getter(instance)
+            if value is not _missing:
+                data[name] = value
+        return data
+
+    def serialize(self, instance):
+        """ Returns the serialized form of ``instance``. """
+        if self.natural_key == 'natural_key':
+            return [_serialize_any(key) for key in instance.natural_key()]
+        elif self.natural_key == 'natural.key':
+            return '.'.join(instance.natural_key())
+        data = {}
+        for name, getter, converter in self.accessors:
+            value = getter(instance)
+            if value is not _missing:
+                data[name] = converter(value)
+        return data
+
+
+def get_serialization_plan(model, fields=()):
+    """ Returns the SerializationPlan for ``model`` and the ``fields`` spec,
+    compiling it only the first time. Specs which cannot be hashed are
+    compiled on each call.
+    """
+    try:
+        key = (model, _spec_key(fields))
+        hash(key) # tuples are returned as they are, with any content
+    except TypeError:
+        return SerializationPlan(model, fields)
+    try:
+        return _serialization_plans[key]
+    except KeyError:
+        pass
+    if len(_serialization_plans) >= serialization_plans_size:
+        _serialization_plans.clear()
+    plan = _serialization_plans[key] = SerializationPlan(model, fields)
+    return plan
+
+
+
+def _collect_related(model, fields, prefix, many, seen, select, prefetch):
+    """ Walks the fields spec, adding the followed FK paths to ``select`` and
+    the m2m paths (and anything below them) to ``prefetch``. Models already
+    in ``seen`` are not walked again, as a full spec recurses on the m2m.
+    """
+    if hasattr(fields, 'serialize'):
+        return
+    fields = _extend_fields(fields)
+    if tuple(fields) in (('natural_key',), ('natural.key',)):
+        return
+    opts = model._meta
+    for f in opts.fields + opts.many_to_many:
+        if fields and not f.name in fields:
+            continue
+        subfields = fields.get(f.name)
+        path = prefix + f.name
+        to = f.rel and f.rel.to
+        if isinstance(f, ManyToManyField):
+            prefetch.append(path)
+        elif fields and isinstance(f, ForeignKey) and subfields is not None:
+            (prefetch if many else select).append(path)
+        else:
+            continue
+        if to not in seen:
+            _collect_related(to, subfields, path + '__',
+                             many or isinstance(f, ManyToManyField),
+                             seen + (to,), select, prefetch)
+
+
+def _prefetch_many(instances, field):
+    """ Fetches the m2m ``field`` of all the instances with two queries. """
+    pending = [instance for instance in instances if instance.pk is not None
+               and field.attname not in instance.__dict__.get(_prefetch_cache, ())]
+    if pending:
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        pairs = list(field.rel.through._default_manager
+                     .filter(**{source + '__in': [instance.pk for instance in pending]})
+                     .values_list(source, target))
+        # the default ordering of the related model is preserved
+        objects = field.rel.to._default_manager.filter(pk__in=set(pk for _, pk in pairs))
+        objects = dict((obj.pk, (position, obj)) for position, obj in enumerate(objects))
+        related = collections.defaultdict(list)
+        for source_pk, target_pk in pairs:
+            if target_pk in objects:
+                related[source_pk].append(objects[target_pk])
+        for instance in pending:
+            instance.__dict__.setdefault(_prefetch_cache, {})[field.attname] = \
+                [obj for _, obj in sorted(related[instance.pk])]
+    return [obj for instance in instances
+            for obj in instance.__dict__.get(_prefetch_cache, {}).get(field.attname, ())]
+
+
+def _prefetch_one(instances, field):
+    """ Fetches the FK ``field`` of all the instances with one query. """
+    cache_name = field.get_cache_name()
+    pending = [instance for instance in instances
+               if not hasattr(instance, cache_name)
+               and getattr(instance, field.attname) is not None]
+    if pending:
+        to, to_field = field.rel.to, field.rel.field_name
+        # the value of the target field (e.g. parent_ptr, a relation itself)
+        attname = to._meta.get_field(to_field).attname
+        values = set(getattr(instance, field.attname) for instance in pending)
+        objects = dict((getattr(obj, attname), obj) for obj in
+            to._default_manager.filter(**{to_field + '__in': values}))
+        for instance in pending:
+            if getattr(instance, field.attname) in objects:
+                setattr(instance, cache_name, objects[getattr(instance, field.attname)])
+    return [getattr(instance, cache_name) for instance in instances
+            if hasattr(instance, cache_name) and getattr(instance, cache_name) is not None]
+
+
+def prefetch_related(instances, lookups):
+    """ Fetches the relations in ``lookups`` (paths in the prefetch_related()
+    format) for a list of model instances, with a constant number of queries
+    per path. This is the fallback for Django versions whose QuerySet does not
+    implement prefetch_related().
+    """
+    for lookup in lookups:
+        objects = instances
+        for name in lookup.split('__'):
+            if not objects:
+                break
+            field = objects[0]._meta.get_field(name)
+            if isinstance(field, ManyToManyField):
+                objects = _prefetch_many(objects, field)
+            else:
+                objects = _prefetch_one(objects, field)
+            objects = dict((id(obj), obj) for obj in objects).values()
+    return instances
+
+
 
 def model_to_dict(instance, fields=None, exclude=None):
     """
@@ -90,51 +498,106 @@ def model_to_dict(instance, fields=None, exclude=None):
     This is similar to the django.forms.models.model_to_dict(), but including
     read_only fields and navigating fully the m2m (when specified).
     """
-    # avoid a circular import
+    data = get_serialization_plan(instance.__class__, fields).to_dict(instance)
+    if exclude and isinstance(data, dict):
+        for name in exclude:
+            data.pop(name, None)
+    return data
 
-    if tuple(fields) == ('natural_key',):
-        return instance.natural_key()
-    elif tuple(fields) == ('natural.key',):
-        return '.'.join(instance.natural_key())
 
-    opts = instance._meta
-    data = {}
-    for f in opts.fields + opts.many_to_many:
-        if fields and not f.name in fields:
-            continue
-        if exclude and f.name in exclude:
-            continue
-        if fields and isinstance(f, ManyToManyField):
-            # Recurse m2m only when fields are explicitly specified
-            if instance.pk is None:
-                data[f.name] = []
-            else:
-                data[f.name] = f.value_from_object(instance)
-        elif fields and isinstance(f, ForeignKey):
-            if fields[f.name] is None:
-                data[f.name] = f.value_from_object(instance)
-            else:
-                data[f.name] = getattr(instance, f.name)
+
+def _serialize_any(thing, fields=()):
+    """
+    Dispatch, all types are routed through here.
+    """
+    ret = None
+    if thing.__class__ in _passthrough_types:
+        ret = thing
+    elif isinstance(thing, Mapping):
+        ret = dict([(k, _serialize_any(thing[k], fields)) for k in thing])
+    elif isinstance(thing, basestring):
+        ret = smart_unicode(thing)
+    elif isinstance(thing, Iterable): # includes QuerySet, list and tuple
+        ret = [_serialize_any(v, fields) for v in thing]
+    elif isinstance(thing, Decimal):
+        ret = str(thing)
+    elif isinstance(thing, Model):
+        ret = _serialize_model(thing, fields)
+    elif isinstance(thing, HttpResponse):
+        ret = thing
+    elif inspect.isfunction(thing): # argument-less function
+        if not inspect.getargspec(thing)[0]:
+            ret = _serialize_any(thing())
+    elif isinstance(thing, Manager):
+        ret = _serialize_any(thing.all(), fields)
+    else:
+        ret = smart_unicode(thing, strings_only=True)
+
+    return ret
+
+
+def _serialize_model(thing, fields=()):
+    """
+    Models. 
+
+    data is an instance of Model.
+    """
+    if hasattr(fields, 'serialize'): # fields is a View, use it to serialize
+        return fields.serialize(thing)
+    return get_serialization_plan(thing.__class__, fields).serialize(thing)
+
+
+def serialize_iter(items, fields=()):
+    """
+    Serializes the items of a collection one at a time, as a generator.
+    Consecutive instances of the same model share the plan lookup.
+    """
+    model, plan = None, None
+    for item in items:
+        if item.__class__ is model:
+            yield plan.serialize(item)
+        elif isinstance(item, Model) and not hasattr(fields, 'serialize'):
+            model = item.__class__
+            plan = get_serialization_plan(model, fields)
+            yield plan.serialize(item)
         else:
-            data[f.name] = f.value_from_object(instance)
-    # add extra attributes/method
-    if fields:
-        missing = [f for f in fields if f not in data]
-        for field in missing:
-            try:
-                attribute = getattr(instance, field)
-            except:
-                print "Attribute %s not found in %s." % (field, instance)
-                continue # fail??
-            try:
-                data[field] = attribute()
-            except:
-                data[field] = attribute
+            yield _serialize_any(item, fields)
 
-    return data
+
+def chunked(iterable, size):
+    """ Splits an iterable into lists of at most ``size`` items. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
+@contextmanager
+def _savepoint(using):
+    sid = transaction.savepoint(using=using)
+    try:
+        yield
+    except:
+        if sid is not None:
+            transaction.savepoint_rollback(sid, using=using)
+        raise
+    if sid is not None:
+        transaction.savepoint_commit(sid, using=using)
 
+def atomic(using=None):
+    """ Returns a context manager running a block in a transaction, rolled
+    back if the block raises: transaction.atomic() where it exists (Django
+    >= 1.6), else commit_on_success(), or a savepoint if a transaction is
+    already managed (e.g. by an enclosing block), which must not be
+    committed halfway.
+    """
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic(using=using)
+    if transaction.is_managed(using=using):
+        return _savepoint(using)
+    return transaction.commit_on_success(using=using)
 
 
 def serialize(data, fields=()):
@@ -142,69 +605,40 @@ def serialize(data, fields=()):
     Recursively serialize a lot of types, and
     in cases where it doesn't recognize the type,
     it will fall back to Django's `smart_unicode`.
+
+    Model instances are serialized through a cached SerializationPlan.
     
     Returns `dict`.
     """
-    def _any(thing, fields=()):
-        """
-        Dispatch, all types are routed through here.
-        """
-        ret = None
-        if isinstance(thing, Mapping):
-            ret = dict([(k, _any(thing[k], fields)) for k in thing])
-        elif isinstance(thing, basestring):
-            ret = smart_unicode(thing)
-        elif isinstance(thing, Iterable): # includes QuerySet, list and tuple
-            ret = [_any(v, fields) for v in thing]
-        elif isinstance(thing, Decimal):
-            ret = str(thing)
-        elif isinstance(thing, Model):
-            ret = _model(thing, fields)
-        elif isinstance(thing, HttpResponse):
-            ret = thing
-        elif inspect.isfunction(thing): # argument-less function
-            if not inspect.getargspec(thing)[0]:
-                ret = _any(thing())
-        elif isinstance(thing, Manager):
-            ret = _any(thing.all(), fields)
-        else:
-            ret = smart_unicode(thing, strings_only=True)
-
-        return ret
-
+    return _serialize_any(data, fields)
 
-    def _model(thing, fields=()):
-        """
-        Models. 
 
-        data is an instance of Model.
-        """
-        fields = fields or ()
-        if hasattr(fields, 'serialize'): # fields is a View, use it to serialize
-            ret = fields.serialize(thing)
-        else: # transform fields into more suitable form
-            extended_fields = {}
-            for field_spec in fields:
-                if isinstance(field_spec, tuple):
-                    extended_fields[field_spec[0]] = field_spec[1]
-                else:
-                    extended_fields[field_spec] = None
-            # prepare initial dict
-            probably = model_to_dict(thing, extended_fields)
-            # recurse serialization:
-            if isinstance(probably, basestring):
-                ret = probably
-            elif isinstance(probably, Mapping):
-                ret = dict(
-                    (key, _any(probably[key], extended_fields.get(key)))
-                    for key in probably
-                    )
-            else:
-                ret = [_any(key) for key in probably]
-        return ret
-    # Kickstart the seralizin'.
-    return _any(data, fields)
 
+def restrict_fields(fields, paths):
+    """ Returns the part of a fields spec selected by a sequence of dotted
+    paths: 'a' selects the field a with all its subfields, 'a.b' just the
+    subfield b of a. Paths which are not in the spec are ignored, and so are
+    the fields for which nothing valid is selected: the result is empty
+    only if all of them are invalid.
+    """
+    restricted = []
+    if isinstance(fields, Mapping):
+        fields = fields.items()
+    for field_spec in fields or ():
+        if isinstance(field_spec, tuple):
+            name, subfields = field_spec
+        else:
+            name, subfields = field_spec, None
+        if name in paths:
+            restricted.append(field_spec)
+            continue
+        prefix = name + '.'
+        subpaths = [path[len(prefix):] for path in paths if path.startswith(prefix)]
+        if subpaths and subfields:
+            subfields = restrict_fields(subfields, subpaths)
+            if subfields:
+                restricted.append((name, subfields))
+    return tuple(restricted)
 
 
 class FieldSpec(collections.defaultdict):
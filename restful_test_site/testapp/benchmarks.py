@@ -0,0 +1,176 @@
+'''
+The benchmark suite of the hot paths: serialization, rendering, decoding,
+pagination and whole requests. Run it with ./manage.py benchmark, which
+creates a test database and fills it with generate_fixtures().
+
+Each benchmark is a function without arguments, measured by measure() in
+operations per second, allocated objects and executed queries per call.
+'''
+from StringIO import StringIO
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.test.client import Client, RequestFactory
+from django.utils import simplejson
+from itertools import count
+from restful.codecs import JSONBackend, JSONArrayReader, JSONResponseEncoder, \
+    XMLResponseEncoder, iterparse_data
+from restful.pagination import CursorPaginator
+from restful import testing
+from restful.resource import RestfulResource
+from restful.utils import serialize, model_to_dict, prefetch_related
+from restful_test_site.testapp.models import TestModel
+from timeit import default_timer
+import gc
+
+
+USERS = 2000
+GROUPS = 10
+GROUPS_PER_USER = 3
+TEST_MODELS = 500
+PAGE_SIZE = 20
+
+FLAT_FIELDS = ('username', 'email', 'is_staff', 'date_joined')
+FK_FIELDS = ('bool_field', ('ct_field', ('app_label', 'model')))
+M2M_FIELDS = ('username', ('groups', ('name',)))
+
+
+def generate_fixtures():
+    """ Fills the database with the instances the benchmarks use. The data
+    is the same on every run. """
+    with transaction.commit_on_success():
+        groups = [Group.objects.create(name='group%d' % i) for i in range(GROUPS)]
+        for i in xrange(USERS):
+            user = User.objects.create(username='user%d' % i, email='user%d@example.com' % i,
+                                       is_staff=i % 2 == 0)
+            user.groups.add(*[groups[(i + j) % GROUPS] for j in range(GROUPS_PER_USER)])
+        contenttypes = list(ContentType.objects.all())
+        for i in xrange(TEST_MODELS):
+            TestModel.objects.create(bool_field=i % 3 == 0,
+                                     ct_field=contenttypes[i % len(contenttypes)])
+
+
+class UserResource(RestfulResource):
+    model = User
+    fields = M2M_FIELDS
+    paginate_by = PAGE_SIZE
+
+
+class CursorUserResource(UserResource):
+    cursor_ordering = ('id',)
+
+
+def _encoder(encoder_class):
+    encoder = encoder_class()
+    encoder.format = encoder_class.format
+    encoder.request = RequestFactory().get('/')
+    return encoder
+
+
+def get_benchmarks():
+    """ Returns the (name, function) pairs of the suite, in order. """
+    users = list(User.objects.order_by('id')[:PAGE_SIZE * 5])
+    prefetched = list(User.objects.order_by('id')[:PAGE_SIZE * 5])
+    prefetch_related(prefetched, ['groups'])
+    test_models = list(TestModel.objects.select_related('ct_field')[:PAGE_SIZE * 5])
+    data = serialize(prefetched, M2M_FIELDS)
+    json_encoder, xml_encoder = _encoder(JSONResponseEncoder), _encoder(XMLResponseEncoder)
+    json_body = JSONBackend().dumps(data).encode('utf-8')
+    xml_body = xml_encoder.render(data).content
+
+    factory = RequestFactory()
+    view, cursor_view = UserResource.as_view(), CursorUserResource.as_view()
+    deep_page = USERS // PAGE_SIZE - 10
+    last_id = User.objects.order_by('id').values_list('id', flat=True)[deep_page * PAGE_SIZE]
+    cursor = CursorPaginator(User.objects.all(), ('id',), PAGE_SIZE).encode_cursor(True, [last_id])
+    client = Client()
+    usernames = ('new%d' % i for i in count())
+
+    return (
+        ('serialize.flat', lambda: serialize(users, FLAT_FIELDS)),
+        ('serialize.fk', lambda: serialize(test_models, FK_FIELDS)),
+        ('serialize.m2m', lambda: serialize(prefetched, M2M_FIELDS)),
+        ('model_to_dict', lambda: model_to_dict(users[0], FLAT_FIELDS)),
+        ('render.json', lambda: json_encoder.render(data)),
+        ('render.xml', lambda: xml_encoder.render(data)),
+        ('decode.json', lambda: simplejson.loads(json_body)),
+        ('decode.json_streamed', lambda: list(JSONArrayReader(StringIO(json_body)))),
+        ('decode.xml', lambda: iterparse_data(StringIO(xml_body))),
+        ('decode.xml_streamed', lambda: list(iterparse_data(StringIO(xml_body), True))),
+        ('paginate.first', lambda: view(factory.get('/?page=1'))),
+        ('paginate.deep', lambda: view(factory.get('/?page=%d' % deep_page))),
+        ('paginate.cursor_deep', lambda: cursor_view(factory.get('/?cursor=' + cursor))),
+        ('client.get_list', lambda: client.get('/users.json')),
+        ('client.get_item', lambda: client.get('/users/%d.json' % users[0].pk)),
+        ('client.post', lambda: client.post('/users.json',
+            simplejson.dumps({'username': next(usernames)}), content_type='application/json')),
+    )
+
+
+def count_queries(function):
+    """ Returns the number of queries executed by a call of function. """
+    return len(testing.count_queries(function)[1])
+
+
+def count_objects(function):
+    """ Returns the number of objects tracked by the garbage collector
+    (i.e. containers: instances, lists, dicts...) allocated by a call of
+    function, net of those it freed.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        start = gc.get_count()[0]
+        result = function() # freed after counting
+        objects = gc.get_count()[0] - start
+        del result
+        return objects
+    finally:
+        gc.enable()
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """ Returns the metrics of function: 'ops' is the number of calls per
+    second (the best of ``repeat`` runs lasting at least ``min_time``
+    seconds each), 'objects' and 'queries' are per call.
+    """
+    metrics = {
+        'queries': count_queries(function),
+        'objects': count_objects(function),
+    }
+    number, elapsed = 1, 0
+    while True: # calibrate the number of calls per run
+        start = default_timer()
+        for i in xrange(number):
+            function()
+        elapsed = default_timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+    best = elapsed
+    for i in xrange(repeat - 1):
+        start = default_timer()
+        for i in xrange(number):
+            function()
+        best = min(best, default_timer() - start)
+    metrics['ops'] = number / best
+    return metrics
+
+
+def compare(metrics, baseline, tolerance=0.2):
+    """ Returns the regressions of metrics with respect to the baseline, as
+    messages: fewer ops per second or more objects beyond the tolerance (a
+    fraction), any increase of queries.
+    """
+    regressions = []
+    for name, current in sorted(metrics.iteritems()):
+        if name not in baseline:
+            continue
+        previous = baseline[name]
+        if current['ops'] < previous['ops'] * (1 - tolerance):
+            regressions.append('%s: %.0f ops/s, was %.0f' % (name, current['ops'], previous['ops']))
+        if current['objects'] > previous['objects'] * (1 + tolerance):
+            regressions.append('%s: %d objects, was %d' % (name, current['objects'], previous['objects']))
+        if current['queries'] > previous['queries']:
+            regressions.append('%s: %d queries, was %d' % (name, current['queries'], previous['queries']))
+    return regressions
@@ -0,0 +1,65 @@
+'''
+Runs the benchmark suite: ./manage.py benchmark [name prefix...]
+'''
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.simple import DjangoTestSuiteRunner
+from django.utils import simplejson
+from optparse import make_option
+from restful_test_site.testapp.benchmarks import generate_fixtures, \
+    get_benchmarks, measure, compare
+
+
+class Command(BaseCommand):
+    help = 'Measures the hot paths on a test database filled with generated ' \
+           'fixtures. Positional arguments select the benchmarks by prefix.'
+    args = '[name prefix...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=5,
+                    help='The number of timed runs of each benchmark (the best counts).'),
+        make_option('--min-time', type='float', default=0.2,
+                    help='The minimum duration of a timed run, in seconds.'),
+        make_option('--save-baseline', metavar='FILE',
+                    help='Saves the results to FILE, as JSON.'),
+        make_option('--baseline', metavar='FILE',
+                    help='Compares the results with FILE, failing on regressions.'),
+        make_option('--tolerance', type='float', default=0.2,
+                    help='The slowdown (or increase of objects) tolerated with '
+                         'respect to the baseline, as a fraction.'),
+    )
+
+    def handle(self, *prefixes, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = simplejson.load(f)
+        # as in production: no query log, no indented JSON
+        debug, settings.DEBUG = settings.DEBUG, False
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        databases = runner.setup_databases()
+        try:
+            generate_fixtures()
+            metrics = self.run(prefixes, options)
+        finally:
+            runner.teardown_databases(databases)
+            settings.DEBUG = debug
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                simplejson.dump(metrics, f, indent=2, sort_keys=True)
+        if baseline is not None:
+            regressions = compare(metrics, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('%d regressions:\n%s' % (len(regressions),
+                                                            '\n'.join(regressions)))
+            self.stdout.write('No regressions.\n')
+
+    def run(self, prefixes, options):
+        metrics = {}
+        self.stdout.write('%-24s %12s %10s %8s\n' % ('benchmark', 'ops/s', 'objects', 'queries'))
+        for name, function in get_benchmarks():
+            if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+                continue
+            metrics[name] = result = measure(function, options['repeat'], options['min_time'])
+            self.stdout.write('%-24s %12.0f %10d %8d\n' % (name, result['ops'],
+                                                          result['objects'], result['queries']))
+        return metrics
@@ -6,4 +6,37 @@ from django.contrib.contenttypes.models import ContentType
 class TestModel(models.Model):
     bool_field = models.BooleanField()
     ct_field = models.ForeignKey(ContentType)
-    
\ No newline at end of file
+    
+class TimestampedModel(models.Model):
+    name = models.CharField(max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class Person(models.Model):
+    name = models.CharField(max_length=50)
+    friends = models.ManyToManyField('self', blank=True)
+
+class Place(models.Model):
+    name = models.CharField(max_length=50)
+
+class Restaurant(Place):
+    stars = models.IntegerField(default=0)
+
+class TagsField(models.TextField):
+    """ A list of tags, stored comma-separated. """
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if isinstance(value, list):
+            return value
+        return value.split(',') if value else []
+
+    def get_prep_value(self, value):
+        return ','.join(value)
+
+class Tagged(models.Model):
+    name = models.CharField(max_length=50)
+    tags = TagsField(blank=True)
+
+class Review(models.Model):
+    restaurant = models.ForeignKey(Restaurant)
+    text = models.CharField(max_length=100, blank=True)
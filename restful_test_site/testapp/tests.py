@@ -63,4 +63,1269 @@ class UtilsTest(TestCase):
         self.assertEqual(result['alternative'], 42)
         self.assertNotIn('bork', result)
         self.assertNotIn('fake', result)
+        pipeline = compile_lookups((foo, bar, baz, bee, bork))
+        self.assertEqual(pipeline(mapping), result)
+        self.assertTrue(compile_lookups([foo, bar, baz, bee, bork]) is pipeline)
+        self.assertEqual(pipeline(QueryDict('baz=nan')), {'alternative': None})
+        pipeline = compile_lookups((foo, lambda mapping: (('other', 2),)))
+        self.assertEqual(pipeline(mapping), {'foo': '1', 'other': 2})
 
+    def test_contenttype_cache(self):
+        contenttype = ContentType.objects.get_for_model(User)
+        with self.assertNumQueries(0):
+            self.assertEqual(smart_contenttype('auth.user'), contenttype)
+        ContentType.objects.clear_cache()
+        self.assertEqual(smart_contenttype('auth.user'), contenttype)
+        self.assertEqual(smart_contenttype('user'), contenttype)
+
+
+
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+from restful_test_site.testapp.models import TestModel, TimestampedModel, Restaurant, Review, \
+    Tagged
+
+class SerializeTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='staff')
+        self.user = User.objects.create(username='john', email='john@example.com')
+        self.user.groups.add(self.group)
+        self.ct = ContentType.objects.get_for_model(User)
+        self.obj = TestModel.objects.create(bool_field=True, ct_field=self.ct)
+
+    def test_flat_fields(self):
+        data = serialize(self.user, ('username', 'email'))
+        self.assertEqual(data, {'username': u'john', 'email': u'john@example.com'})
+
+    def test_related_fields(self):
+        data = serialize(self.obj, ('bool_field', 'ct_field'))
+        self.assertEqual(data, {'bool_field': True, 'ct_field': self.ct.pk})
+        data = serialize(self.obj, (('ct_field', ('app_label', 'model')),))
+        self.assertEqual(data, {'ct_field': {'app_label': u'auth', 'model': u'user'}})
+        data = serialize(self.obj, (('ct_field', ('natural.key',)),))
+        self.assertEqual(data, {'ct_field': u'auth.user'})
+        data = serialize(self.user, ('username', ('groups', ('name',))))
+        self.assertEqual(data, {'username': u'john', 'groups': [{'name': u'staff'}]})
+
+    def test_extra_attributes(self):
+        data = serialize([self.user], ('get_full_name', 'is_staff', 'missing'))
+        self.assertEqual(data, [{'get_full_name': u'', 'is_staff': False}])
+
+    def test_plans_are_cached(self):
+        fields = ('username', ('groups', ('name',)))
+        plan = get_serialization_plan(User, fields)
+        self.assertTrue(get_serialization_plan(User, fields) is plan)
+        self.assertEqual(plan.serialize(self.user), serialize(self.user, fields))
+        self.assertEqual(model_to_dict(self.user, {'username': None}), {'username': u'john'})
+
+    def test_unhashable_spec(self):
+        fields = ('username', ('groups', ['name']))
+        self.assertEqual(serialize(self.user, fields),
+                         {'username': u'john', 'groups': [{'name': u'staff'}]})
+
+
+from django.test.client import RequestFactory
+from django.contrib.auth.models import Permission
+from django.db.models.query import QuerySet
+from django.utils import simplejson
+
+# The queries fetching an m2m relation of the serialized objects: a join
+# with prefetch_related(), else the through rows, then the related objects.
+M2M_QUERIES = 1 if hasattr(QuerySet, 'prefetch_related') else 2
+
+class RelatedLookupsTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        paginate_by = 10
+        fields = ('username', ('groups', ('name', ('permissions', ('codename',)))))
+
+    class TestModelResource(RestfulResource):
+        model = TestModel
+        fields = ('bool_field', ('ct_field', ('natural.key',)))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        permissions = Permission.objects.all()
+        for i in range(6):
+            group = Group.objects.create(name='group%d' % i)
+            group.permissions.add(*permissions[i:i + 2])
+            user = User.objects.create(username='user%d' % i)
+            user.groups.add(group)
+            TestModel.objects.create(ct_field=ContentType.objects.get_for_model(User))
+
+    def get(self, resource, path='/', **kwargs):
+        response = resource.as_view()(self.factory.get(path), **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return simplejson.loads(response.content)
+
+    def test_lookups(self):
+        plan = get_serialization_plan(User, self.Resource.fields)
+        self.assertEqual(plan.related_lookups(), ((), ('groups', 'groups__permissions')))
+        plan = get_serialization_plan(TestModel, self.TestModelResource.fields)
+        self.assertEqual(plan.related_lookups(), (('ct_field',), ()))
+
+    def test_constant_queries(self):
+        # the count, the page, the groups and their permissions
+        with self.assertNumQueries(2 + 2 * M2M_QUERIES):
+            small = self.get(self.Resource, '/?items=2')
+        with self.assertNumQueries(2 + 2 * M2M_QUERIES):
+            large = self.get(self.Resource, '/?items=6')
+        self.assertEqual(len(small['items']), 2)
+        self.assertEqual(len(large['items']), 6)
+        self.assertEqual(large['items'][1]['groups'][0]['name'], 'group1')
+        self.assertEqual(len(large['items'][1]['groups'][0]['permissions']), 2)
+        with self.assertNumQueries(1):
+            data = self.get(self.TestModelResource)
+        self.assertEqual(data[0]['ct_field'], 'auth.user')
+
+    def test_single_object(self):
+        user = User.objects.get(username='user3')
+        data = self.get(self.Resource, pk=str(user.pk))
+        self.assertEqual(data['groups'][0]['name'], 'group3')
+
+
+class ColumnsTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', 'email')
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create(username='john', email='john@example.com')
+
+    def test_plan_columns(self):
+        plan = get_serialization_plan(User, ('username', 'email'))
+        self.assertEqual(plan.values_fields, ('username', 'email'))
+        plan = get_serialization_plan(User, ('username', ('groups', ('name',))))
+        self.assertEqual(plan.values_fields, None)
+        self.assertEqual(plan.only_fields, ('username',))
+        plan = get_serialization_plan(User, ('username', 'get_full_name'))
+        self.assertEqual(plan.only_fields, None)
+        self.assertEqual(get_serialization_plan(User, ()).only_fields, None)
+
+    def test_collection_values(self):
+        resource = self.Resource(request=self.factory.get('/'), kwargs={})
+        queryset = resource.apply_columns(resource.get_queryset(), values=True)
+        self.assertEqual(list(queryset), [{'username': u'john', 'email': u'john@example.com'}])
+        response = self.Resource.as_view()(self.factory.get('/'))
+        self.assertEqual(simplejson.loads(response.content),
+                         [{'username': 'john', 'email': 'john@example.com'}])
+
+    def test_custom_field(self):
+        Tagged.objects.create(name='first', tags=['a', 'b'])
+        plan = get_serialization_plan(Tagged, ('name', 'tags'))
+        self.assertEqual(plan.values_fields, None)
+        self.assertEqual(plan.only_fields, ('name', 'tags'))
+        response = RestfulResource.as_view(model=Tagged, fields=('name', 'tags'))(self.factory.get('/'))
+        self.assertEqual(simplejson.loads(response.content), [{'name': 'first', 'tags': ['a', 'b']}])
+
+    def test_object_only(self):
+        response = self.Resource.as_view()(self.factory.get('/'), pk=str(self.user.pk))
+        self.assertEqual(simplejson.loads(response.content),
+                         {'username': 'john', 'email': 'john@example.com'})
+
+
+class StreamingTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        streaming = True
+        chunk_size = 2
+        fields = ('username', ('groups', ('name',)))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        group = Group.objects.create(name='staff')
+        for i in range(5):
+            User.objects.create(username='user%d' % i).groups.add(group)
+
+    def test_json_stream(self):
+        response = self.Resource.as_view()(self.factory.get('/'))
+        self.assertFalse(isinstance(response._container, list))
+        with self.assertNumQueries(1 + 3 * 2):
+            data = simplejson.loads(response.content)
+        self.assertEqual(len(data), 5)
+        self.assertEqual(data[4], {'username': 'user4', 'groups': [{'name': 'staff'}]})
+
+    def test_empty_stream(self):
+        User.objects.all().delete()
+        response = self.Resource.as_view()(self.factory.get('/'))
+        self.assertEqual(simplejson.loads(response.content), [])
+
+    def test_xml_stream(self):
+        User.objects.filter(username='user4').update(first_name=u'J\xfcrgen')
+        view = self.Resource.as_view(fields=('username', 'first_name'))
+        response = view(self.factory.get('/'), format='.xml')
+        self.assertFalse(isinstance(response._container, list))
+        content = response.content
+        self.assertTrue(content.startswith('<?xml'))
+        self.assertEqual(content.count('<resource>'), 5)
+        self.assertTrue('<first_name>J\xc3\xbcrgen</first_name>' in content)
+        self.assertTrue(content.endswith('</resource></response>'))
+        buffered = self.Resource.as_view(streaming=False, fields=('username', 'first_name'))
+        self.assertEqual(buffered(self.factory.get('/'), format='.xml').content, content)
+
+
+import datetime
+from decimal import Decimal
+from django.conf import settings
+
+class JSONBackendTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', 'date_joined')
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        User.objects.create(username='john', date_joined=datetime.datetime(2011, 2, 14, 10, 30))
+
+    def test_backend(self):
+        data = {'when': datetime.date(2011, 2, 14), 'amount': Decimal('1.50')}
+        self.assertEqual(JSONBackend().dumps(data), '{"amount":"1.50","when":"2011-02-14"}')
+        self.assertEqual(JSONBackend(indent=2).dumps([1]), '[\n  1\n]')
+
+    def test_indentation(self):
+        view = self.Resource.as_view()
+        compact = view(self.factory.get('/')).content
+        self.assertEqual(compact, '[{"username":"john","date_joined":"2011-02-14 10:30:00"}]')
+        indented = view(self.factory.get('/?indent')).content
+        self.assertTrue('\n  ' in indented)
+        self.assertEqual(simplejson.loads(indented), simplejson.loads(compact))
+        self.assertEqual(view(self.factory.get('/?indent=0')).content, compact)
+        debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            self.assertEqual(view(self.factory.get('/')).content, indented)
+        finally:
+            settings.DEBUG = debug
+
+    def test_streaming(self):
+        view = self.Resource.as_view(streaming=True)
+        self.assertEqual(view(self.factory.get('/')).content,
+                         '[{"username":"john","date_joined":"2011-02-14 10:30:00"}]')
+        indented = view(self.factory.get('/?indent')).content
+        self.assertEqual(simplejson.loads(indented)[0]['username'], 'john')
+
+
+from django.http import Http404
+
+class ConditionalTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        paginate_by = 10
+        last_modified_field = 'date_joined'
+        fields = ('username',)
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create(username='john',
+            date_joined=datetime.datetime(2011, 2, 14, 10, 30))
+        self.view = self.Resource.as_view()
+
+    def test_collection(self):
+        response = self.view(self.factory.get('/'))
+        etag = response['ETag']
+        self.assertEqual(response['Last-Modified'], 'Mon, 14 Feb 2011 10:30:00 GMT')
+        with self.assertNumQueries(1):
+            response = self.view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertNotEqual(self.view(self.factory.get('/?page=1'))['ETag'], etag)
+        User.objects.create(username='jack', date_joined=self.user.date_joined)
+        response = self.view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+
+    def test_object(self):
+        pk = str(self.user.pk)
+        response = self.view(self.factory.get('/',
+            HTTP_IF_MODIFIED_SINCE='Mon, 14 Feb 2011 10:30:00 GMT'), pk=pk)
+        self.assertEqual(response.status_code, 304)
+        response = self.view(self.factory.get('/',
+            HTTP_IF_MODIFIED_SINCE='Mon, 14 Feb 2011 10:29:59 GMT'), pk=pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertRaises(Http404, self.view, self.factory.get('/'), pk='0')
+
+    def test_related_changes(self):
+        group = Group.objects.create(name='staff')
+        self.user.groups.add(group)
+        view = self.Resource.as_view(fields=('username', ('groups', ('name',))))
+        etag = view(self.factory.get('/'))['ETag']
+        self.assertEqual(view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag)).status_code, 304)
+        group.name = 'admin'
+        group.save()
+        response = view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.user.groups.clear()
+        self.assertEqual(view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag)).status_code, 200)
+
+    def test_content_hash(self):
+        view = self.Resource.as_view(last_modified_field=None, etag_content=True)
+        etag = view(self.factory.get('/'))['ETag']
+        response = view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+
+from restful.cache import get_response_cache
+from restful_test_site.testapp.models import Person
+
+class ResponseCacheTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        cache_timeout = 60
+        fields = ('username', ('groups', ('name',)))
+
+    def setUp(self):
+        get_response_cache().clear()
+        self.factory = RequestFactory()
+        self.group = Group.objects.create(name='staff')
+        self.user = User.objects.create(username='john')
+        self.user.groups.add(self.group)
+        self.view = self.Resource.as_view()
+
+    def get(self, path='/', **kwargs):
+        return simplejson.loads(self.view(self.factory.get(path), **kwargs).content)
+
+    def test_hit(self):
+        data = self.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(), data)
+        self.get('/?b=2&a=1')
+        with self.assertNumQueries(0):
+            self.get('/?a=1&b=2')
+        with self.assertNumQueries(1 + M2M_QUERIES):
+            self.get(pk=str(self.user.pk))
+
+    def test_invalidation(self):
+        self.get()
+        self.group.name = 'admins'
+        self.group.save()
+        self.assertEqual(self.get()[0]['groups'], [{'name': 'admins'}])
+        self.user.groups.clear()
+        self.assertEqual(self.get()[0]['groups'], [])
+        User.objects.create(username='jack')
+        self.assertEqual(len(self.get()), 2)
+
+    def test_watched(self):
+        from restful import cache
+        cache._watched.discard(Person)
+        Person.objects.create(name='ann')
+        self.assertEqual(get_response_cache().get(cache._version_key(Person)), None)
+        view = RestfulResource.as_view(model=Person, fields=('name',), cache_timeout=60)
+        self.assertFalse(Person in cache._watched)
+        view(self.factory.post('/', '{"name": "bob"}', content_type='application/json'))
+        self.assertTrue(Person in cache._watched)
+        Person.objects.create(name='cid')
+        self.assertNotEqual(get_response_cache().get(cache._version_key(Person)), None)
+
+    def test_watched_default_fields(self):
+        from restful import cache
+        cache._watched.discard(Group)
+        view = RestfulResource.as_view(model=User, cache_timeout=60, fieldset_marker='set',
+            fields=FieldSpec(('username', ('groups', ('name',))), short=('username',)))
+        view(self.factory.get('/?set=short'))
+        self.assertTrue(Group in cache._watched)
+
+    def test_etag(self):
+        view = self.Resource.as_view(etag_content=True)
+        etag = view(self.factory.get('/'))['ETag']
+        response = view(self.factory.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+
+from django.test import TransactionTestCase
+from django.utils.unittest import skipUnless
+
+class BulkWriteTest(TransactionTestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', ('groups', ('name',)))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.groups = [Group.objects.create(name='group%d' % i) for i in range(2)]
+        self.view = self.Resource.as_view()
+
+    def send(self, method, data, **kwargs):
+        request = getattr(self.factory, method)('/', simplejson.dumps(data),
+                                                content_type='application/json')
+        response = self.view(request, **kwargs)
+        return response.status_code, simplejson.loads(response.content)
+
+    def test_post(self):
+        items = [{'username': 'user%d' % i, 'groups': [self.groups[i % 2].pk]}
+                 for i in range(4)]
+        status, results = self.send('post', items)
+        self.assertEqual(status, 201)
+        self.assertEqual([result['status'] for result in results], [201] * 4)
+        user = User.objects.get(pk=results[3]['id'])
+        self.assertEqual(user.username, 'user3')
+        self.assertEqual(list(user.groups.all()), [self.groups[1]])
+
+    def test_ids_without_m2m(self):
+        status, results = self.send('post', [{'username': 'user%d' % i} for i in range(3)])
+        self.assertEqual(status, 201)
+        self.assertEqual(sorted(result['id'] for result in results),
+                         sorted(User.objects.values_list('pk', flat=True)))
+
+    @skipUnless(hasattr(QuerySet, 'bulk_create'), 'bulk_create() is not available')
+    def test_batched_insert(self):
+        items = [{'username': 'user%d' % i, 'groups': [self.groups[0].pk]} for i in range(3)]
+        (status, results), queries = count_queries(self.send, 'post', items)
+        self.assertEqual(status, 201)
+        self.assertEqual(len([sql for sql in queries if sql.startswith('INSERT INTO "auth_user"')]), 1)
+        self.assertEqual(dict((result['id'], item['username']) for result, item in zip(results, items)),
+                         dict(User.objects.values_list('pk', 'username')))
+        self.assertEqual(self.groups[0].user_set.count(), 3)
+
+    def test_put(self):
+        users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        items = [{'id': user.pk, 'first_name': 'John', 'groups': [self.groups[0].pk]}
+                 for user in users]
+        status, results = self.send('put', items)
+        self.assertEqual(status, 200)
+        self.assertEqual(User.objects.filter(first_name='John').count(), 3)
+        self.assertEqual(self.groups[0].user_set.count(), 3)
+
+    def test_streamed(self):
+        self.Resource.stream_requests = True
+        self.Resource.bulk_batch_size = 2
+        try:
+            items = [{'username': 'user%d' % i, 'groups': [self.groups[0].pk]} for i in range(5)]
+            status, results = self.send('post', items)
+            self.assertEqual(status, 201)
+            self.assertEqual(len(set(result['id'] for result in results)), 5)
+            self.assertEqual(self.groups[0].user_set.count(), 5)
+            items = [{'username': 'other%d' % i} for i in range(4)] + ['invalid']
+            status, results = self.send('post', items)
+            self.assertEqual(status, 400)
+            self.assertEqual([result['status'] for result in results], [201] * 4 + [400])
+            self.assertEqual(User.objects.filter(username__startswith='other').count(), 0)
+        finally:
+            del self.Resource.stream_requests, self.Resource.bulk_batch_size
+
+    def test_all_or_nothing(self):
+        status, results = self.send('put', [{'id': 0, 'first_name': 'John'}, 42])
+        self.assertEqual(status, 400)
+        self.assertEqual([result['status'] for result in results], [404, 400])
+        status, results = self.send('post', [{'username': 'john'}, 'invalid'])
+        self.assertEqual(status, 400)
+        self.assertFalse(User.objects.exists())
+        status, results = self.send('post', [{'username': 'john'}, {'username': 'john'}])
+        self.assertEqual(status, 400)
+        self.assertEqual(len(results), 2)
+        self.assertFalse(User.objects.exists())
+
+
+class ReferencesTest(TestCase):
+    class Resource(RestfulResource):
+        model = TestModel
+        fields = ('bool_field', ('ct_field', ('natural.key',)))
+
+    def setUp(self):
+        self.resource = self.Resource(request=RequestFactory().get('/'), kwargs={})
+        self.user_ct = ContentType.objects.get_for_model(User)
+        self.group_ct = ContentType.objects.get_for_model(Group)
+
+    def test_batch(self):
+        items = [{'ct_field': self.user_ct.pk}, {'ct_field': {'id': str(self.group_ct.pk)}},
+                 {'ct_field_id': self.user_ct.pk}, {'ct_field': 'auth.group'},
+                 {'bool_field': True}]
+        with self.assertNumQueries(1):
+            references = self.resource.resolve_references(items)
+            instances = [self.resource.update_attrs(TestModel(), item, references)
+                         for item in items]
+        self.assertEqual([instance.ct_field_id for instance in instances[:4]],
+                         [self.user_ct.pk, self.group_ct.pk, self.user_ct.pk, self.group_ct.pk])
+        self.assertTrue(instances[4].bool_field)
+
+    def test_missing(self):
+        self.assertRaises(ObjectDoesNotExist, self.resource.update_attrs,
+                          TestModel(), {'ct_field': 0})
+        self.assertRaises(ObjectDoesNotExist, self.resource.update_attrs,
+                          TestModel(), {'ct_field': 'auth.nothing'})
+        request = RequestFactory().post('/', simplejson.dumps({'ct_field': 0}),
+                                        content_type='application/json')
+        response = self.Resource.as_view()(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('ct_field' in response.content)
+
+    def test_inherited_target(self):
+        # the pk of a multi-table child is a relation, parent_ptr
+        class Resource(RestfulResource):
+            model = Review
+        restaurant = Restaurant.objects.create(name='Chez John')
+        resource = Resource(request=RequestFactory().get('/'), kwargs={})
+        review = resource.update_attrs(Review(), {'restaurant': restaurant.pk})
+        self.assertEqual(review.restaurant, restaurant)
+
+    def test_prefetch_inherited_target(self):
+        restaurant = Restaurant.objects.create(name='Chez John')
+        Review.objects.create(restaurant=restaurant)
+        reviews = list(Review.objects.all())
+        with self.assertNumQueries(1):
+            prefetch_related(reviews, ['restaurant'])
+        with self.assertNumQueries(0):
+            self.assertEqual(reviews[0].restaurant.name, 'Chez John')
+
+
+from restful_test_site.testapp.views import UserResource
+
+class SaveM2MTest(TestCase):
+    def setUp(self):
+        self.resource = UserResource(request=RequestFactory().get('/'), kwargs={})
+        self.groups = [Group.objects.create(name='group%d' % i) for i in range(4)]
+        self.user = User.objects.create(username='john')
+        self.user.groups.add(*self.groups[:2])
+
+    def current(self):
+        return sorted(self.user.groups.values_list('pk', flat=True))
+
+    def test_unchanged(self):
+        with self.assertNumQueries(1):
+            self.resource.save_m2m(self.user, {'groups': [g.pk for g in self.groups[:2]]})
+        self.assertEqual(self.current(), [g.pk for g in self.groups[:2]])
+
+    def test_delta(self):
+        self.resource.save_m2m(self.user, {'groups': [{'id': self.groups[1].pk},
+                                                      str(self.groups[2].pk)]})
+        self.assertEqual(self.current(), [self.groups[1].pk, self.groups[2].pk])
+        self.resource.save_m2m(self.user, {'groups': []})
+        self.assertEqual(self.current(), [])
+
+    def test_unknown(self):
+        self.assertRaises(ObjectDoesNotExist, self.resource.save_m2m,
+                          self.user, {'groups': [0]})
+
+
+class CursorPaginationTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        paginate_by = 2
+        cursor_ordering = ('-date_joined', 'id')
+        fields = ('username',)
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        for i in range(5):
+            User.objects.create(username='user%d' % i,
+                date_joined=datetime.datetime(2011, 2, 1 + i // 2, 10, 30))
+        self.view = self.Resource.as_view()
+
+    def get(self, cursor=None):
+        path = '/' if cursor is None else '/?cursor=' + cursor
+        return simplejson.loads(self.view(self.factory.get(path)).content)
+
+    def names(self, page):
+        return [item['username'] for item in page['items']]
+
+    def test_forward_and_back(self):
+        with self.assertNumQueries(1):
+            first = self.get()
+        self.assertEqual(self.names(first), ['user4', 'user2'])
+        self.assertEqual(first['prev'], None)
+        self.assertFalse('total' in first)
+        second = self.get(first['next'])
+        self.assertEqual(self.names(second), ['user3', 'user0'])
+        third = self.get(second['next'])
+        self.assertEqual(self.names(third), ['user1'])
+        self.assertEqual(third['next'], None)
+        back = self.get(third['prev'])
+        self.assertEqual(self.names(back), ['user3', 'user0'])
+        back = self.get(back['prev'])
+        self.assertEqual(self.names(back), ['user4', 'user2'])
+        self.assertEqual(back['prev'], None)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(Http404, self.get, 'garbage')
+
+
+class CountStrategyTest(TestCase):
+    def setUp(self):
+        get_response_cache().clear()
+        self.factory = RequestFactory()
+        for i in range(5):
+            User.objects.create(username='user%d' % i)
+
+    def get(self, path='/', **attrs):
+        attrs.setdefault('model', User)
+        attrs.setdefault('paginate_by', 2)
+        attrs.setdefault('fields', ('username',))
+        view = RestfulResource.as_view(**attrs)
+        return simplejson.loads(view(self.factory.get(path)).content)
+
+    def test_cached(self):
+        with self.assertNumQueries(2):
+            data = self.get(count_strategy='cached')
+        self.assertEqual(data['total'], 5)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get('/?page=2', count_strategy='cached')['total'], 5)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get('/?username__startswith=user1',
+                count_strategy='cached', queryset=User.objects.all(),
+                get_lookups=(LookupParameter('username__startswith'),))['total'], 1)
+        User.objects.create(username='user5')
+        self.assertEqual(self.get(count_strategy='cached')['total'], 6)
+
+    def test_estimate(self):
+        # sqlite has no estimate: counts are exact
+        data = self.get(count_strategy='estimate')
+        self.assertEqual((data['total'], data['pages']), (5, 3))
+
+    def test_more(self):
+        with self.assertNumQueries(1):
+            data = self.get(count_strategy='more')
+        self.assertFalse('total' in data or 'pages' in data)
+        self.assertEqual((data['from'], data['to'], data['more']), (1, 2, True))
+        data = self.get('/?page=3', count_strategy='more')
+        self.assertEqual((data['from'], data['to'], data['more']), (5, 5, False))
+        self.assertEqual([item['username'] for item in data['items']], ['user4'])
+        self.assertRaises(Http404, self.get, '/?page=4', count_strategy='more')
+
+
+class QuerysetCacheTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        queryset_cache_size = 128
+        get_lookups = (LookupParameter('username'),
+                       LookupParameter('id__in', int, split=True))
+
+    def get_queryset(self, path):
+        resource = self.Resource(request=RequestFactory().get(path), kwargs={})
+        return resource.get_queryset()
+
+    def test_filters(self):
+        User.objects.create(username='john')
+        User.objects.create(username='jack')
+        self.assertEqual([user.username for user in self.get_queryset('/?username=john')], ['john'])
+        first = self.get_queryset('/?id__in=1,2')
+        second = self.get_queryset('/?id__in=1,2')
+        self.assertFalse(first is second)
+        self.assertEqual(str(first.query), str(second.query))
+        self.assertEqual(len(first), 2)
+        self.assertTrue((User, (('id__in', (1, 2)),)) in RestfulMixin._queryset_cache)
+
+    def test_model_only(self):
+        User.objects.create(username='john')
+        User.objects.create(username='jack')
+        view = RestfulResource.as_view(model=User, fields=('username',),
+                                       get_lookups=self.Resource.get_lookups)
+        response = view(RequestFactory().get('/?username=jack'))
+        self.assertEqual(simplejson.loads(response.content), [{'username': 'jack'}])
+
+    def test_disabled(self):
+        RestfulMixin._queryset_cache.clear()
+        resource = RestfulResource(model=User, get_lookups=self.Resource.get_lookups,
+                                   request=RequestFactory().get('/?username=john'), kwargs={})
+        resource.get_queryset()
+        self.assertEqual(RestfulMixin._queryset_cache, {})
+
+
+class SparseFieldsTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        sparse_fields_marker = 'fields'
+        fields = ('username', 'email', 'password',
+                  ('groups', ('name', ('permissions', ('codename', 'name')))))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        group = Group.objects.create(name='staff')
+        group.permissions.add(Permission.objects.all()[0])
+        user = User.objects.create(username='john', email='john@example.com')
+        user.groups.add(group)
+        self.view = self.Resource.as_view()
+
+    def get(self, path):
+        return simplejson.loads(self.view(self.factory.get(path)).content)
+
+    def test_restrict_fields(self):
+        spec = self.Resource.fields
+        self.assertEqual(restrict_fields(spec, ['email', 'groups.permissions.codename', 'last_login']),
+                         ('email', ('groups', (('permissions', ('codename',)),))))
+        self.assertEqual(restrict_fields(spec, ['groups']), (spec[3],))
+        self.assertEqual(restrict_fields(spec, ['groups.foo', 'bar']), ())
+
+    def test_narrow(self):
+        with self.assertNumQueries(1):
+            data = self.get('/?fields=username,email')
+        self.assertEqual(data, [{'username': 'john', 'email': 'john@example.com'}])
+        data = self.get('/?fields=username,groups.name')
+        self.assertEqual(data, [{'username': 'john', 'groups': [{'name': 'staff'}]}])
+        self.assertEqual(len(self.get('/?fields=nothing')[0]), 4)
+        self.assertEqual(len(self.get('/?fields=last_login,username')[0]), 1)
+
+    def test_bounded_plans(self):
+        from restful import utils
+        utils._serialization_plans.clear()
+        size, utils.serialization_plans_size = utils.serialization_plans_size, 3
+        try:
+            for fields in ('username', 'email', 'password', 'username,email', 'email,groups'):
+                self.get('/?fields=' + fields)
+                self.assertTrue(len(utils._serialization_plans) <= 3)
+        finally:
+            utils.serialization_plans_size = size
+
+
+import zlib
+
+class CompressionTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', 'email')
+        content_encodings = ('gzip', 'deflate')
+        compress_min_length = 200
+
+    def setUp(self):
+        get_response_cache().clear()
+        self.factory = RequestFactory()
+        for i in range(10):
+            User.objects.create(username='user%d' % i, email='user%d@example.com' % i)
+
+    def get(self, encoding=None, path='/', HTTP_IF_NONE_MATCH=None, **attrs):
+        view = self.Resource.as_view(**attrs)
+        request = self.factory.get(path)
+        if HTTP_IF_NONE_MATCH is not None:
+            request.META['HTTP_IF_NONE_MATCH'] = HTTP_IF_NONE_MATCH
+        if encoding is not None:
+            request.META['HTTP_ACCEPT_ENCODING'] = encoding
+        return view(request)
+
+    def content(self, response):
+        return ''.join(response)
+
+    def test_negotiation(self):
+        plain = self.get()
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(plain['Vary'], 'Accept, Accept-Encoding')
+        response = self.get('gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.content, 31), plain.content)
+        response = self.get('gzip;q=0.5, deflate;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.get('*;q=1, gzip;q=0')
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.content), plain.content)
+        self.assertFalse(self.get('identity').has_header('Content-Encoding'))
+        self.assertFalse(self.get('gzip', compress_min_length=10000).has_header('Content-Encoding'))
+
+    def test_streaming(self):
+        plain = self.get(streaming=True)
+        response = self.get('gzip', streaming=True)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(self.content(response), 31), self.content(plain))
+
+    def test_cached(self):
+        plain = self.get(cache_timeout=60).content
+        with self.assertNumQueries(0):
+            response = self.get('gzip', cache_timeout=60)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.content, 31), plain)
+        with self.assertNumQueries(0):
+            response = self.get(cache_timeout=60)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, plain)
+
+    def test_etags(self):
+        etag = self.get(etag_content=True)['ETag']
+        gzipped = self.get('gzip', etag_content=True)['ETag']
+        self.assertEqual(gzipped, etag[:-1] + ';gzip"')
+        self.assertEqual(self.get('deflate', etag_content=True)['ETag'], etag[:-1] + ';deflate"')
+        for attrs in ({'etag_content': True}, {'etag_content': True, 'cache_timeout': 60}):
+            for client_etag in (etag, gzipped):
+                response = self.get('gzip', HTTP_IF_NONE_MATCH=client_etag, **attrs)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], gzipped)
+                self.assertEqual(response['Vary'], 'Accept, Accept-Encoding')
+            response = self.get(HTTP_IF_NONE_MATCH=gzipped, **attrs)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+
+
+from restful import msgpack_fallback
+
+class MsgPackTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', 'date_joined')
+
+    def test_fallback(self):
+        data = {u'a': [None, True, False, 0, 127, 128, -32, -33, 2 ** 40, -2 ** 40, 1.5],
+                u'b': u'\xe8' * 40, u'c': u'x' * 300, u'd': dict((str(i), i) for i in range(20)),
+                u'e': msgpack_fallback.ExtType(5, 'abcd')}
+        packed = msgpack_fallback.packb(data)
+        self.assertEqual(msgpack_fallback.unpackb(packed), data)
+        self.assertRaises(ValueError, msgpack_fallback.unpackb, packed[:-1])
+        self.assertRaises(TypeError, msgpack_fallback.packb, object())
+        try:
+            import msgpack
+        except ImportError:
+            return
+        self.assertEqual(msgpack.unpackb(packed, raw=False), data)
+
+    def test_extension_types(self):
+        data = [datetime.datetime(2011, 2, 14, 10, 30, 15, 123), datetime.date(2011, 2, 14),
+                datetime.time(10, 30), Decimal('3.14')]
+        self.assertEqual(msgpack_loads(msgpack_dumps(data)), data)
+
+    def test_resource(self):
+        factory = RequestFactory()
+        view = self.Resource.as_view()
+        joined = datetime.datetime(2011, 2, 14, 10, 30)
+        response = view(factory.post('/', msgpack_dumps({'username': 'john', 'date_joined': joined}),
+                                     content_type='application/x-msgpack'), format='msgpack')
+        self.assertEqual(msgpack_loads(response.content), {'username': 'john', 'date_joined': joined})
+        self.assertEqual(User.objects.get(username='john').date_joined, joined)
+        response = view(factory.get('/'), format='msgpack')
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        self.assertEqual(msgpack_loads(response.content), [{'username': 'john', 'date_joined': joined}])
+
+
+class NegotiationTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username',)
+
+    def setUp(self):
+        User.objects.create(username='john')
+        self.factory = RequestFactory()
+
+    def get(self, accept=None, resource=None, **kwargs):
+        request = self.factory.get('/')
+        if accept is not None:
+            request.META['HTTP_ACCEPT'] = accept
+        return (resource or self.Resource).as_view()(request, **kwargs)
+
+    def test_table(self):
+        renderers = self.Resource.get_renderers()
+        self.assertEqual(renderers.keys(), ['json', 'xml', 'msgpack'])
+        self.assertTrue(renderers['xml'][1] is XMLResponseEncoder.__dict__['render'])
+        self.assertTrue(self.Resource.get_renderers() is renderers)
+
+    def test_accept(self):
+        self.assertEqual(self.get()['Content-Type'], 'application/json')
+        self.assertEqual(self.get('*/*')['Content-Type'], 'application/json')
+        self.assertEqual(self.get('application/xml')['Content-Type'], 'application/xml')
+        self.assertEqual(self.get('application/xml;q=0.5, application/json;q=0.8')['Content-Type'],
+                         'application/json')
+        self.assertEqual(self.get('application/*, application/xml')['Content-Type'], 'application/xml')
+        self.assertEqual(self.get('text/html, */*;q=0.1')['Content-Type'], 'application/json')
+        self.assertEqual(self.get('application/xml', format='.json')['Content-Type'], 'application/json')
+        self.assertEqual(self.get('application/xml')['Vary'], 'Accept')
+        self.assertFalse(self.get(format='json').has_header('Vary'))
+
+    def test_not_acceptable(self):
+        self.assertEqual(self.get('text/html').status_code, 406)
+        self.assertEqual(self.get('application/json;q=0').status_code, 406)
+        self.assertEqual(self.get(format='yaml').status_code, 406)
+        self.assertEqual(self.get('text/html')['Vary'], 'Accept')
+
+    def test_default_format(self):
+        class Resource(self.Resource):
+            format = 'xml'
+        self.assertEqual(self.get(resource=Resource)['Content-Type'], 'application/xml')
+        self.assertEqual(self.get('*/*', resource=Resource)['Content-Type'], 'application/xml')
+
+    def test_inherited_mimetype(self):
+        class TextEncoder(JSONResponseEncoder):
+            format = 'text'
+            def render(self, response):
+                return HttpResponse('text', mimetype=self.mimetype)
+        class Resource(TextEncoder, self.Resource):
+            pass
+        self.assertEqual(Resource.get_renderers()['text'][0], 'application/json')
+        self.assertEqual(self.get(resource=Resource).content, 'text')
+
+    def test_override(self):
+        class Resource(self.Resource):
+            def render(self, response):
+                return HttpResponse('custom')
+        self.assertEqual(self.get(resource=Resource).content, 'custom')
+        self.assertEqual(self.get(resource=Resource, format='xml').content, 'custom')
+
+
+from StringIO import StringIO
+
+class StreamedDecodingTest(TestCase):
+    def items(self, content, chunk_size=3):
+        return list(JSONArrayReader(StringIO(content), chunk_size))
+
+    def test_json_array(self):
+        content = simplejson.dumps([1234567, -1.5e10, u'a, [b] "c"\xe8', {'a': [1, {'b': None}]},
+                                    True, [], {}, 'x' * 20])
+        self.assertEqual(self.items(content), simplejson.loads(content))
+        self.assertEqual(self.items(content, 65536), simplejson.loads(content))
+        self.assertEqual(self.items(' [ 1 , 2 ] \n'), [1, 2])
+        self.assertEqual(self.items('[]'), [])
+        for invalid in ('{"a": 1}', '[1 2]', '[1, 2', '[1,]', '[1] 2', '[1, {"a": }]'):
+            self.assertRaises(ValueError, self.items, invalid)
+
+    def test_chunk_boundaries(self):
+        for content in ('[1.5]', '[12.25, 3]', '[1.5e10]', '[-7, 1E-3, true, null, 120]'):
+            for chunk_size in range(1, len(content) + 1):
+                self.assertEqual(self.items(content, chunk_size), simplejson.loads(content),
+                                 '%s in chunks of %d' % (content, chunk_size))
+
+    def test_json_object(self):
+        reader = JSONArrayReader(StringIO('  {"a": [1, 2]}'), 3)
+        self.assertEqual(reader.peek(), '{')
+        self.assertEqual(reader.load(), {'a': [1, 2]})
+
+    def test_xml(self):
+        items = iterparse_data(StringIO(
+            '<response><resource><a>1</a></resource><resource><a>2</a></resource></response>'), True)
+        self.assertTrue(isinstance(items, Iterator))
+        self.assertEqual(list(items), [{'a': '1'}, {'a': '2'}])
+
+
+class XMLDecoderTest(TestCase):
+    def render(self, data):
+        encoder = XMLResponseEncoder()
+        encoder.format = 'xml'
+        return encoder.render(data).content
+
+    def test_mirror(self):
+        data = {'username': u'j\xf6hn', 'is_staff': True, 'groups': [1, 2],
+                'owner': {'id': 3, 'tags': [{'name': 'a'}, {'name': 'b'}]}, 'none': None}
+        self.assertEqual(iterparse_data(StringIO(self.render(data))),
+                         {'username': u'j\xf6hn', 'is_staff': '1', 'groups': ['1', '2'],
+                          'owner': {'id': '3', 'tags': [{'name': 'a'}, {'name': 'b'}]}})
+        self.assertEqual(iterparse_data(StringIO(self.render([{'a': 1}, {'a': False}]))),
+                         [{'a': '1'}, {'a': '0'}])
+
+    def test_resource(self):
+        class Resource(RestfulResource):
+            model = User
+            fields = ('username', 'is_staff')
+        body = self.render([{'username': 'john', 'is_staff': True}, {'username': 'jack'},
+                            {'username': 'paul', 'is_staff': False}])
+        request = RequestFactory().post('/', body, content_type='application/xml')
+        response = Resource.as_view()(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(User.objects.filter(is_staff=True).values_list('username', flat=True)),
+                         [u'john'])
+        self.assertEqual(User.objects.get(username='paul').is_staff, False)
+
+
+from restful_test_site.testapp import benchmarks
+
+class BenchmarkTest(TestCase):
+    def test_measure(self):
+        User.objects.create(username='john')
+        metrics = benchmarks.measure(lambda: list(User.objects.all()), repeat=1, min_time=0.001)
+        self.assertEqual(metrics['queries'], 1)
+        self.assertTrue(metrics['objects'] > 0 and metrics['ops'] > 0)
+
+    def test_compare(self):
+        baseline = {'a': {'ops': 100, 'objects': 10, 'queries': 2},
+                    'b': {'ops': 100, 'objects': 10, 'queries': 2}}
+        metrics = {'a': {'ops': 85, 'objects': 12, 'queries': 2},
+                   'b': {'ops': 70, 'objects': 13, 'queries': 3},
+                   'c': {'ops': 1, 'objects': 1000, 'queries': 100}}
+        self.assertEqual(benchmarks.compare(metrics, baseline),
+                         ['b: 70 ops/s, was 100', 'b: 13 objects, was 10', 'b: 3 queries, was 2'])
+
+
+from django.db import connection
+from restful.timing import phases_timed
+
+class TimingTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', ('groups', ('name',)))
+        paginate_by = 5
+        timing = True
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        group = Group.objects.create(name='group')
+        for i in range(10):
+            User.objects.create(username='user%d' % i).groups.add(group)
+        self.timings = []
+        phases_timed.connect(self.receiver)
+
+    def tearDown(self):
+        phases_timed.disconnect(self.receiver)
+
+    def receiver(self, sender, resource, request, response, timing, **kwargs):
+        self.timings.append(timing)
+
+    def test_phases(self):
+        response = self.Resource.as_view()(self.factory.get('/?page=2'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Server-Timing'))
+        timing, = self.timings
+        self.assertEqual([phase.name for phase in timing.phases],
+                         ['query', 'paginate', 'fetch', 'serialize', 'render'])
+        phases = dict((phase.name, phase) for phase in timing.phases)
+        self.assertEqual(phases['paginate'].queries, 1) # count
+        self.assertEqual(phases['fetch'].queries, 1 + M2M_QUERIES) # page and groups
+        self.assertEqual(timing.queries, 2 + M2M_QUERIES)
+        self.assertTrue(timing.duration >= sum(phase.duration for phase in timing.phases))
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_write(self):
+        view = self.Resource.as_view(timing_header=True)
+        response = view(self.factory.post('/', '{"username": "john"}',
+                                          content_type='application/json'))
+        timing, = self.timings
+        self.assertEqual([phase.name for phase in timing.phases],
+                         ['decode', 'write', 'serialize', 'render'])
+        header = response['Server-Timing']
+        self.assertTrue(header.startswith('decode;dur='))
+        self.assertTrue('db;dur=' in header and ', total;dur=' in header)
+
+    def test_disabled(self):
+        view = self.Resource.as_view(timing=False)
+        response = view(self.factory.get('/'))
+        self.assertEqual(self.timings, [])
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+from restful.testing import QueryBudgetMixin
+from restful.timing import RepeatedQueries, query_shape
+
+class RepeatedQueriesTest(QueryBudgetMixin, TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', ('groups', ('name',)))
+        paginate_by = 5
+        detect_repeated_queries = 'raise'
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        group = Group.objects.create(name='group')
+        for i in range(20):
+            User.objects.create(username='user%d' % i).groups.add(group)
+
+    def view(self, **attrs):
+        return self.Resource.as_view(**attrs)
+
+    def test_query_shape(self):
+        self.assertEqual(query_shape("SELECT a FROM t2 WHERE b = 'it''s' AND c IN (1, 2.5, 3) LIMIT 21"),
+                         "SELECT a FROM t2 WHERE b = ? AND c IN (...) LIMIT ?")
+
+    def test_detect(self):
+        self.view()(self.factory.get('/'))
+        view = self.view(auto_related=False)
+        self.assertRaises(RepeatedQueries, view, self.factory.get('/'))
+        view(self.factory.get('/?items=1')) # a single row repeats nothing
+
+    def test_budget(self):
+        self.assertPageQueryBudget(4, self.view(), lambda query: self.factory.get('/?' + query))
+        self.assertRaises(self.failureException, self.assertPageQueryBudget, 4,
+            self.view(auto_related=False, detect_repeated_queries=None),
+            lambda query: self.factory.get('/?' + query), sizes=(1, 2))
+        response = self.assertQueryBudget(2, self.view(), self.factory.post('/',
+            '{"username": "john"}', content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertRaises(self.failureException, self.assertQueryBudget, 0,
+                          lambda: list(User.objects.all()))
+
+
+from restful.batch import BatchResource
+
+class BatchTest(TransactionTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.john = User.objects.create(username='john', email='john@example.com')
+
+    def batch(self, subrequests, format='json', **attrs):
+        view = BatchResource.as_view(**attrs)
+        request = self.factory.post('/batch', JSONBackend().dumps(subrequests),
+                                    content_type='application/json')
+        return view(request, format=format)
+
+    def test_get(self):
+        response = self.batch([{'path': '/users/%d' % self.john.pk},
+                               {'path': '/users?page=1'},
+                               {'path': '/nowhere'}])
+        self.assertEqual(response.status_code, 200)
+        user, users, missing = simplejson.loads(response.content)
+        self.assertEqual(user['status'], 200)
+        self.assertEqual(user['headers']['Content-Type'], 'application/json')
+        self.assertEqual(user['body']['username'], 'john')
+        self.assertEqual([item['username'] for item in users['body']], ['john'])
+        self.assertEqual(missing['status'], 404)
+        response = self.batch([{'path': '/users/%d' % self.john.pk}], format='xml')
+        self.assertTrue('<username>john</username>' in response.content)
+        self.assertEqual(self.batch({'path': '/users'}).status_code, 400)
+        self.assertEqual(self.batch([{'path': '/users'}] * 3, max_requests=2).status_code, 400)
+
+    def test_bulk(self):
+        response = self.batch([
+            {'method': 'POST', 'path': '/users', 'body': [{'username': 'paul'}, {'username': 'ringo'}]},
+            {'method': 'PUT', 'path': '/users/0', 'body': {'email': 'j@example.com'}},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in simplejson.loads(response.content)],
+                         [201, 400])
+        self.assertFalse(User.objects.filter(username__in=['paul', 'ringo']).exists())
+
+    def test_data(self):
+        view = RestfulResource.as_view(model=User)
+        self.assertFalse(hasattr(view(self.factory.get('/')), 'data'))
+
+    def test_threads(self):
+        # threads have their own connection, which can't see the in-memory
+        # test database: just check the results and their order
+        response = self.batch([{'path': '/nowhere/%d' % i} for i in range(5)],
+                              thread_pool_size=2)
+        results = simplejson.loads(response.content)
+        self.assertEqual([result['status'] for result in results], [404] * 5)
+        self.assertEqual([result['error'].count('nowhere/%d' % i) > 0
+                          for i, result in enumerate(results)], [True] * 5)
+
+    def test_writes(self):
+        response = self.batch([
+            {'method': 'POST', 'path': '/users', 'body': {'username': 'paul'}},
+            {'method': 'PUT', 'path': '/users/%d' % self.john.pk, 'body': {'email': 'j@example.com'}},
+            {'path': '/users'},
+        ])
+        created, updated, users = simplejson.loads(response.content)
+        self.assertEqual((created['status'], updated['status']), (200, 200))
+        self.assertEqual(created['body']['username'], 'paul')
+        self.assertEqual(sorted(item['username'] for item in users['body']), ['john', 'paul'])
+        self.assertEqual(User.objects.get(pk=self.john.pk).email, 'j@example.com')
+
+    def test_rollback(self):
+        response = self.batch([
+            {'method': 'POST', 'path': '/users', 'body': {'username': 'paul'}},
+            {'method': 'PUT', 'path': '/users/0', 'body': {'email': 'j@example.com'}},
+            {'method': 'POST', 'path': '/users', 'body': {'username': 'george'}},
+        ])
+        self.assertEqual(response.status_code, 400)
+        results = simplejson.loads(response.content)
+        self.assertEqual([result['status'] for result in results], [200, 400, 424])
+        self.assertFalse(User.objects.filter(username__in=['paul', 'george']).exists())
+        response = self.batch([
+            {'method': 'POST', 'path': '/users', 'body': {'username': 'paul'}},
+            {'method': 'PUT', 'path': '/users/0', 'body': {'email': 'j@example.com'}},
+        ], atomic_writes=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(User.objects.filter(username='paul').exists())
+
+
+from django.db.models.signals import pre_save
+from restful.cache import get_versions
+from restful.testing import count_queries
+
+class PatchTest(TestCase):
+    class Resource(RestfulResource):
+        model = User
+        fields = ('username', 'email', ('groups', ('name',)))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.john = User.objects.create(username='john', email='john@example.com',
+                                        first_name='John')
+
+    def patch(self, data, pk=None, resource=None):
+        request = self.factory.put('/', simplejson.dumps(data), content_type='application/json')
+        request.method = request.META['REQUEST_METHOD'] = 'PATCH'
+        view = (resource or self.Resource).as_view()
+        return view(request, pk=self.john.pk if pk is None else pk)
+
+    def test_narrow(self):
+        versions = get_versions([User])
+        response, queries = count_queries(self.patch, {'email': 'j@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(simplejson.loads(response.content)['email'], 'j@example.com')
+        update = queries[0]
+        self.assertTrue(update.startswith('UPDATE') and 'email' in update
+                        and 'first_name' not in update and 'last_login' not in update)
+        self.assertEqual(len(queries), 3) # the update, the user and the groups
+        john = User.objects.get(pk=self.john.pk)
+        self.assertEqual((john.email, john.first_name), ('j@example.com', 'John'))
+        self.assertNotEqual(get_versions([User]), versions)
+        self.assertEqual(self.patch({'email': 'x'}, pk=0).status_code, 400)
+
+    def test_references(self):
+        class Resource(RestfulResource):
+            model = TestModel
+        ct = ContentType.objects.get_for_model(User)
+        instance = TestModel.objects.create(bool_field=False,
+                                            ct_field=ContentType.objects.get_for_model(Group))
+        response = self.patch({'ct_field': 'auth.user'}, pk=instance.pk, resource=Resource)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(TestModel.objects.get(pk=instance.pk).ct_field, ct)
+        response = self.patch({'ct_field': 'auth.nothing'}, pk=instance.pk, resource=Resource)
+        self.assertEqual(response.status_code, 400)
+
+    def test_hooks(self):
+        saved = []
+        def receiver(sender, instance, **kwargs):
+            saved.append(instance.email)
+        pre_save.connect(receiver, sender=User)
+        try:
+            group = Group.objects.create(name='staff')
+            response = self.patch({'email': 'j@example.com'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(saved, ['j@example.com'])
+        finally:
+            pre_save.disconnect(receiver, sender=User)
+        response = self.patch({'groups': [group.pk]})
+        self.assertEqual(simplejson.loads(response.content)['groups'], [{'name': 'staff'}])
+
+    def test_auto_now(self):
+        class Resource(RestfulResource):
+            model = TimestampedModel
+        instance = TimestampedModel.objects.create(name='old')
+        past = datetime.datetime(2000, 1, 1)
+        TimestampedModel.objects.filter(pk=instance.pk).update(updated_at=past)
+        response = self.patch({'name': 'new'}, pk=instance.pk, resource=Resource)
+        self.assertEqual(response.status_code, 200)
+        instance = TimestampedModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.name, 'new')
+        self.assertTrue(instance.updated_at > past)
+
+    def test_put(self):
+        request = self.factory.put('/', '{"first_name": "Johnny"}', content_type='application/json')
+        response = self.Resource.as_view()(request, pk=self.john.pk)
+        self.assertEqual(response.status_code, 200)
+        john = User.objects.get(pk=self.john.pk)
+        self.assertEqual((john.first_name, john.email), ('Johnny', 'john@example.com'))
+
+
+class SymmetricalM2MTest(TransactionTestCase):
+    class Resource(RestfulResource):
+        model = Person
+        fields = ('name', ('friends', ('name',)))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.ann = Person.objects.create(name='ann')
+        self.bob = Person.objects.create(name='bob')
+
+    def write(self, method, data, pk=None):
+        request = getattr(self.factory, method)('/', simplejson.dumps(data),
+                                                content_type='application/json')
+        return self.Resource.as_view()(request, pk=pk)
+
+    def friends(self, person):
+        return sorted(person.friends.values_list('name', flat=True))
+
+    def test_mirrored(self):
+        response = self.write('post', {'name': 'cid', 'friends': [self.ann.pk, self.bob.pk]})
+        self.assertEqual(response.status_code, 200)
+        cid = Person.objects.get(name='cid')
+        self.assertEqual(self.friends(cid), ['ann', 'bob'])
+        self.assertEqual(self.friends(self.ann), ['cid'])
+        self.write('put', {'friends': [self.bob.pk]}, pk=cid.pk)
+        self.assertEqual(self.friends(cid), ['bob'])
+        self.assertEqual(self.friends(self.ann), [])
+        self.assertEqual(self.friends(self.bob), ['cid'])
+
+    def test_bulk(self):
+        response = self.write('post', [{'name': 'cid', 'friends': [self.ann.pk]},
+                                       {'name': 'dan', 'friends': [self.ann.pk]}])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.friends(self.ann), ['cid', 'dan'])
+
+    def test_rollback(self):
+        response = self.write('post', {'name': 'cid', 'friends': [self.ann.pk, 0]})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Person.objects.filter(name='cid').exists())
+        response = self.write('put', {'name': 'anna', 'friends': [0]}, pk=self.ann.pk)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Person.objects.get(pk=self.ann.pk).name, 'ann')
@@ -1,5 +1,6 @@
 from django.conf.urls.defaults import *
 
+from restful.batch import BatchResource
 from restful_test_site.testapp.views import *
 
 from django.contrib import admin
@@ -7,6 +8,7 @@ admin.autodiscover()
 
 urlpatterns = patterns('',
     (r'^users(/(?P<pk>\d+))?(?P<format>\.\w+)?', UserResource.as_view()),
+    (r'^batch(?P<format>\.\w+)?$', BatchResource.as_view()),
     # Example:
     # (r'^restful_test_site/', include('restful_test_site.foo.urls')),
 